@@ -1 +1,6 @@
-from .server import main
+def main():
+
+    # Imported here so that other commands (e.g. ingest)
+    # don't start the server's database and work pool
+    from .server import main
+    main()
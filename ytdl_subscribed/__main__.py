@@ -13,4 +13,11 @@ if (__package__ is None and not hasattr(sys, 'frozen')):
 import ytdl_subscribed
 
 if (__name__ == '__main__'):
+
+    # $ python -m ytdl_subscribed ingest <file>
+    # $ python -m ytdl_subscribed import <directory>
+    if (len(sys.argv) > 1):
+        from ytdl_subscribed.cli import run
+        sys.exit(run(sys.argv[1], sys.argv[2:]))
+
     ytdl_subscribed.main()
@@ -1,6 +1,8 @@
 import json
-import os
+import queue
 import subprocess
+from datetime import datetime
+from urllib.parse import urlencode
 
 from bottle import (
     TEMPLATE_PATH,
@@ -17,21 +19,39 @@ from bottle import (
 
 from bottle_json_pretty import JSONPrettyPlugin
 
-from .db import YtdlDatabase
-from .download import download
+from .db import ThreadLocalDatabase, YtdlDatabase
+from .events import EventBroker, publish
+from .ingest import ingest_urls, parse_url_list
+from .limits import StreamLimiter
 from .log import log
+from .media import STREAM_RETRY_S, serve_media
 from .pool import WorkPool
 from .utils import (
+    get_daily_window_start,
     get_env_override,
     get_env_override_set,
     get_resource_path,
     get_storage_path,
-    get_ydl_options
+    get_ydl_options,
+    is_collection_url
 )
 
-db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite', quiet=False))
-db.do_migrations()
+db_backend = get_env_override('YDL_DB_BACKEND', default='sqlite', quiet=False)
+setup_db = YtdlDatabase.factory(db_backend)
+setup_db.do_migrations()
 
+# Refuse to start with settings that would be ignored
+setup_db.check_settings()
+
+# Requests are handled on multiple threads and
+# connections cannot be shared between threads
+db = ThreadLocalDatabase(db_backend)
+
+# Pages and listings only read so they get their own connections
+# that never wait on (or block) writers
+reader = ThreadLocalDatabase(db_backend, read_only=True)
+
+events = EventBroker.get_instance()
 pool = WorkPool.get_instance()
 
 # Help Bottle find the templates since the
@@ -40,21 +60,188 @@ TEMPLATE_PATH.insert(0, get_resource_path('views'))
 app = Bottle(autojson=False)
 app.install(JSONPrettyPlugin())
 
+# Upper bound on the number of rows returned by any listing
+MAX_PAGE_SIZE = 100
+
+# Time between comments sent to keep idle event streams open
+EVENT_KEEPALIVE_S = 15
+
+# Event streams and media files sent through Python each hold a request
+# thread for as long as they are open so only this many may be open at
+# once. Keep it below YDL_SERVER_THREADS so that the API stays responsive
+streams = StreamLimiter(max(1, int(get_env_override('YDL_SERVER_MAX_STREAMS', default=8))))
+
+# Priority classes that can be requested by name
+JOB_PRIORITIES = {
+    'INTERACTIVE': YtdlDatabase.priority.INTERACTIVE,
+    'REFRESH': YtdlDatabase.priority.REFRESH,
+    'BACKFILL': YtdlDatabase.priority.BACKFILL
+}
+
+def get_page_options(prefix=''):
+    '''
+    Parse the paging and filter query parameters shared by all video listings.
+
+    `prefix` selects an independent cursor when a page shows multiple listings.
+    '''
+
+    query = request.query
+
+    try:
+        options = {
+            'max_count': min(MAX_PAGE_SIZE, max(1, int(query.get('limit', 15)))),
+            'after': query.get(prefix + 'after'),
+            'extractor': query.get('extractor') or None,
+            'collection_db_id': query.get('collection'),
+            'since': parse_local_datetime(query.get('since') or None, 'since'),
+            'before': parse_local_datetime(query.get('before') or None, 'before')
+        }
+
+        for key in ('after', 'collection_db_id'):
+            if (not options[key] is None):
+                options[key] = int(options[key])
+
+    except ValueError:
+        raise HTTPError(400, "'limit', 'after', and 'collection' must be integers")
+
+    return options
+
+def get_next_after(items, page_options, key='id'):
+    '''
+    Return the cursor for the page following `items` or `None` if it was the last.
+
+    The cursor is the `key` of the last item.
+    '''
+
+    if (len(items) == page_options['max_count']):
+        return items[-1][key]
+
+    return None
+
+def get_page_link(key, after):
+    '''
+    Build a link to the current page with the cursor `key` moved to `after`.
+
+    Returns `None` if there is no next page.
+    '''
+
+    if (after is None):
+        return None
+
+    query = dict(request.query.items())
+    query[key] = after
+
+    return '?' + urlencode(query)
+
+def get_page_response(items, page_options, key='id'):
+    '''
+    Build the JSON response for one page of a video listing.
+    '''
+
+    items = reader.result_to_simple_type(items)
+
+    return {
+        'count': len(items),
+        'items': items,
+        'next': get_next_after(items, page_options, key)
+    }
+
+def parse_local_datetime(value, name):
+    '''
+    Parse the date and time given as the parameter `name` into the local
+    time format that timestamps are stored in.
+
+    Returns `None` if no value was given.
+    '''
+
+    if (value is None):
+        return None
+
+    try:
+        value = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPError(400, f"'{name}' must be a date and time like YYYY-MM-DD HH:MM")
+
+    # Stored in local time like every other timestamp
+    if (not value.tzinfo is None):
+        value = value.astimezone().replace(tzinfo=None)
+
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+def get_requested_not_before(params=None):
+    '''
+    Parse when a submitted job may start from either the `not_before`
+    (local date and time) or `defer` (`maintenance` for the next
+    maintenance window) form fields or the given `params`.
+
+    Returns `None` if the job may start right away.
+    '''
+
+    if (params is None):
+        params = request.forms
+
+    not_before = params.get('not_before') or None
+    defer = params.get('defer') or None
+
+    if (not not_before is None and not defer is None):
+        raise HTTPError(400, "Only one of 'not_before' and 'defer' may be given")
+
+    if (not defer is None):
+
+        if (defer != 'maintenance'):
+            raise HTTPError(400, "'defer' must be 'maintenance'")
+
+        settings = reader.get_settings()
+        if (settings['YDL_MAINTENANCE_START'] is None):
+            raise HTTPError(400, 'No maintenance window is configured')
+
+        not_before = get_daily_window_start(settings['YDL_MAINTENANCE_START'], settings['YDL_MAINTENANCE_END'])
+
+        return not_before.strftime('%Y-%m-%d %H:%M:%S')
+
+    return parse_local_datetime(not_before, 'not_before')
+
+def get_requested_priority(params, default):
+    '''
+    Parse the priority class of a submitted job from the `priority` field.
+    '''
+
+    priority = params.get('priority') or default
+    if (not priority.upper() in JOB_PRIORITIES):
+        raise HTTPError(400, f"'priority' must be one of: {', '.join(name.lower() for name in JOB_PRIORITIES)}")
+
+    return JOB_PRIORITIES[priority.upper()]
+
 @app.get('/')
 @view('index')
 def bottle_index():
+    failed_options = get_page_options('failed_')
+    queue_options = get_page_options('queue_')
+    history_options = get_page_options('history_')
+
+    failed = reader.get_failed_downloads(**failed_options)
+    queue = reader.get_queued_downloads(**queue_options)
+    history = reader.get_recent_downloads(**history_options)
+
+    settings = reader.get_settings()
+
     return {
-        'format_options': db.get_format_options(),
-        'default_format': db.get_settings()['default_format'],
-        'failed': db.get_failed_downloads(),
-        'queue': db.get_queued_downloads(),
-        'history': db.get_recent_downloads(),
+        'format_options': reader.get_format_options(),
+        'default_format': settings['default_format'],
+        'maintenance_window': None if settings['YDL_MAINTENANCE_START'] is None
+            else f"{settings['YDL_MAINTENANCE_START']}-{settings['YDL_MAINTENANCE_END']}",
+        'failed': failed,
+        'failed_more': get_page_link('failed_after', get_next_after(failed, failed_options)),
+        'queue': queue,
+        'queue_more': get_page_link('queue_after', get_next_after(queue, queue_options)),
+        'history': history,
+        'history_more': get_page_link('history_after', get_next_after(history, history_options)),
     }
 
 @app.get('/collection/<collection_db_id:re:[0-9]*>')
 @view('collection')
 def bottle_collection_by_id(collection_db_id):
-    data = db.get_collection(collection_db_id)
+    data = reader.get_collection(collection_db_id)
 
     if (data is None):
         raise HTTPError(404, 'Could not find the requested collection.')
@@ -66,7 +253,7 @@ def bottle_collection_by_id(collection_db_id):
 @app.get('/collection/<extractor>/<collection_online_id>')
 @view('collection')
 def bottle_collection_by_extractor(extractor, collection_online_id):
-    data = db.get_collection_by_extractor_id(extractor, collection_online_id)
+    data = reader.get_collection_by_extractor_id(extractor, collection_online_id)
 
     if (data is None):
         raise HTTPError(404, 'Could not find the requested collection.')
@@ -84,19 +271,18 @@ def bottle_video_by_id(video_db_id):
     }
 
 @app.get('/video/<video_db_id:re:[0-9]*>/download')
-@view('video')
 def bottle_video_download(video_db_id):
 
-    # TODO: Using the current directory won't always be accurate
-    # For now, this works for the Docker container or if you
-    # always run ytdl-subscribed from the same directory
+    # TODO: Resolving relative paths from the current directory won't
+    # always be accurate. For now, this works for the Docker container
+    # or if you always run ytdl-subscribed from the same directory
     data = bottle_api_get_video(video_db_id)
-    return static_file(data['filepath'], root=os.getcwd(), download=True)
+    return serve_media(data['filepath'], download=True, limiter=streams)
 
 @app.get('/video/<extractor>/<video_online_id>')
 @view('video')
 def bottle_video_by_extractor(extractor, video_online_id):
-    data = db.get_video_by_extractor_id(extractor, video_online_id)
+    data = reader.get_video_by_extractor_id(extractor, video_online_id)
 
     if (data is None):
         raise HTTPError(404, 'Could not find the requested video.')
@@ -108,11 +294,11 @@ def bottle_video_by_extractor(extractor, video_online_id):
 @app.get('/settings')
 @view('settings')
 def bottle_show_settings():
-    settings = db.get_settings()
+    settings = reader.get_settings()
 
     return {
         'settings': settings,
-        'ydl_options': db.get_ydl_options(),
+        'ydl_options': reader.get_ydl_options(),
         'overrides': get_env_override_set(settings)
     }
 
@@ -122,11 +308,13 @@ def bottle_static(filename):
 
 @app.get('/api/queue')
 def bottle_api_get_queue():
-    download_queue = db.result_to_simple_type(db.get_queued_downloads())
-    return {
-        'count': len(download_queue),
-        'items': download_queue
-    }
+    '''
+    List the queued and running jobs, including the ones for channels
+    and playlists that don't have a video. Paged by `job_id`.
+    '''
+
+    page_options = get_page_options()
+    return get_page_response(reader.get_queued_jobs(**page_options), page_options, key='job_id')
 
 # / is for backwards compatibility with the original project
 @app.post('/')
@@ -146,42 +334,236 @@ def bottle_api_add_to_queue():
     if (url is None or len(url) == 0):
         raise HTTPError(400, "Missing 'url' query parameter")
 
-    error = ''
-    error = download(url, request_options)
-    # pool.pool.apply_async(download, (url, request_options))
+    not_before = get_requested_not_before()
+
+    # Channels and playlists can take hours so they
+    # don't get to hold up single videos by default
+    priority = get_requested_priority(request.forms, 'backfill' if is_collection_url(url) else 'interactive')
 
-    if (len(error) > 0):
-        raise HTTPError(500, error)
+    # Downloads can take hours so only record the request here
+    # The work pool picks it up as soon as a worker is free
+    # (and the job is due)
+    job_db_id = db.queue_job(url, request_options, not_before=not_before, priority=priority)
+    pool.notify()
+
+    publish('job', {'id': job_db_id, 'url': url, 'state': 'queued', 'not_before': not_before})
 
     if (do_redirect):
         return redirect('/')
 
-    return bottle_api_get_queue()
+    # Built from what was queued since a worker may
+    # already have picked up (or even finished) the job
+    response.status = 202
+    response.set_header('Location', f'/api/queue/{job_db_id}')
 
-@app.get('/api/recent')
-def bottle_api_get_recent():
-    recent = db.result_to_simple_type(db.get_recent_downloads())
     return {
-        'count': len(recent),
-        'items': recent
+        'id': job_db_id,
+        'url': url,
+        'request_options': request_options,
+        'not_before': not_before,
+        'priority': priority,
+        'state': 'queued'
     }
 
+@app.post('/api/queue/bulk')
+def bottle_api_add_many_to_queue():
+    '''
+    Queue many URLs at once from a request body that is either a JSON
+    list of URLs or plain text with one URL per line.
+
+    The format, priority (backfill by default), and start time are
+    taken from the query string and apply to every URL.
+
+    Streams one JSON result per URL (newline-delimited) with the
+    `job_id` it was queued as or the `error` that kept it from being queued.
+    '''
+
+    not_before = get_requested_not_before(request.query)
+    priority = get_requested_priority(request.query, 'backfill')
+
+    format_id = request.query.get('format') or reader.get_settings()['default_format']
+
+    try:
+        urls = list(parse_url_list(request.body.read().decode('utf-8')))
+    except ValueError as e:
+        raise HTTPError(400, f'Could not parse the list of URLs: {e}')
+
+    def on_queued(results):
+
+        pool.notify()
+
+        for result in results:
+            if ('job_id' in result):
+                publish('job', {'id': result['job_id'], 'url': result['url'], 'state': 'queued', 'not_before': not_before})
+
+    response.content_type = 'application/x-ndjson'
+
+    # Bottle's JSON plugin only handles dicts so the lines are encoded here
+    for result in ingest_urls(db, urls, format_id, not_before=not_before, priority=priority, on_queued=on_queued):
+        yield json.dumps(result) + '\n'
+
+@app.get('/api/queue/<job_db_id:re:[0-9]*>')
+def bottle_api_get_job(job_db_id):
+    data = reader.get_job(job_db_id)
+
+    if (data is None):
+        raise HTTPError(404, 'Could not find the requested job. It may have already finished.')
+
+    data = reader.result_to_simple_type(data)
+    data['request_options'] = json.loads(data['request_options'])
+
+    return data
+
+@app.get('/api/events')
+def bottle_api_events():
+    '''
+    Stream job, video, and download progress events using Server-Sent Events.
+    '''
+
+    if (not streams.acquire()):
+        raise HTTPError(503, 'Too many event streams are open. Try again later.', **{'Retry-After': STREAM_RETRY_S})
+
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+
+    # Stop proxies (i.e. nginx) from buffering the stream
+    response.set_header('X-Accel-Buffering', 'no')
+
+    def stream():
+
+        # Subscribed here so that a stream that is never
+        # started doesn't leave its subscription behind
+        subscription = events.subscribe()
+
+        try:
+            yield 'retry: 5000\n\n'
+
+            while (True):
+
+                try:
+                    event, data = subscription.get(timeout=EVENT_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+        finally:
+            events.unsubscribe(subscription)
+
+    return streams.wrap(stream())
+
+@app.get('/api/recent')
+def bottle_api_get_recent():
+    page_options = get_page_options()
+    return get_page_response(reader.get_recent_downloads(**page_options), page_options)
+
 @app.get('/api/failed')
 def bottle_api_get_failed():
-    failed = db.result_to_simple_type(db.get_failed_downloads())
+    page_options = get_page_options()
+    return get_page_response(reader.get_failed_downloads(**page_options), page_options)
+
+@app.post('/api/collection/<collection_db_id:re:[0-9]*>/schedule')
+def bottle_api_set_collection_schedule(collection_db_id):
+    update_sched = request.forms.get('update_sched')
+
+    if (db.get_collection(collection_db_id) is None):
+        raise HTTPError(404, 'Could not find the requested collection.')
+
+    schedules = db.get_update_schedules()
+    matches = [row for row in schedules if str(row['id']) == update_sched or row['name'] == update_sched]
+
+    if (len(matches) == 0):
+        names = ', '.join(row['name'] for row in schedules)
+        raise HTTPError(400, f"Invalid 'update_sched'. Expected one of: {names}")
+
+    db.set_collection_update_schedule(collection_db_id, matches[0]['id'])
+
+    return db.result_to_simple_type(db.get_collection(collection_db_id))
+
+@app.get('/api/extractor/limit')
+def bottle_api_get_extractor_limits():
     return {
-        'count': len(failed),
-        'items': failed
+        'items': reader.result_to_simple_type(list(reader.get_extractor_limits().values()))
     }
 
+@app.post('/api/extractor/<name>/limit')
+def bottle_api_set_extractor_limit(name):
+    '''
+    Change how many jobs for a site may run at once and how often they may
+    start. Blank or missing values remove the respective limit.
+    '''
+
+    try:
+        max_concurrent = request.forms.get('max_concurrent') or None
+        if (not max_concurrent is None):
+            max_concurrent = int(max_concurrent)
+
+        jobs_per_minute = request.forms.get('jobs_per_minute') or None
+        if (not jobs_per_minute is None):
+            jobs_per_minute = float(jobs_per_minute)
+
+        burst = int(request.forms.get('burst') or 1)
+
+    except ValueError:
+        raise HTTPError(400, "'max_concurrent' and 'burst' must be integers and 'jobs_per_minute' a number")
+
+    if ((not max_concurrent is None and max_concurrent < 1)
+            or (not jobs_per_minute is None and jobs_per_minute <= 0) or burst < 1):
+        raise HTTPError(400, "'max_concurrent', 'jobs_per_minute', and 'burst' must be positive")
+
+    db.set_extractor_limit(name, max_concurrent, jobs_per_minute, burst)
+    pool.notify()
+
+    return db.result_to_simple_type(db.get_extractor_limits()[name.lower()])
+
+@app.get('/api/bandwidth')
+def bottle_api_get_bandwidth():
+    budget = pool.governor.get_budget()
+
+    return {
+        'current_limit_kBps': int(budget // 1024) if budget else None,
+        'schedule': reader.result_to_simple_type(reader.get_bandwidth_schedule())
+    }
+
+@app.post('/api/bandwidth')
+def bottle_api_set_bandwidth():
+    '''
+    Replace the bandwidth schedule with a JSON list of
+    `{"start_time": "HH:MM", "end_time": "HH:MM", "limit_kBps": N}` windows.
+    '''
+
+    windows = request.json
+    if (not isinstance(windows, list)):
+        raise HTTPError(400, 'Expected a JSON list of bandwidth windows')
+
+    try:
+        windows = [
+            (
+                datetime.strptime(window['start_time'], '%H:%M').strftime('%H:%M'),
+                datetime.strptime(window['end_time'], '%H:%M').strftime('%H:%M'),
+                int(window['limit_kBps'])
+            ) for window in windows
+        ]
+    except (KeyError, TypeError, ValueError):
+        raise HTTPError(400, "Each window needs a 'start_time' and 'end_time' (HH:MM) and a 'limit_kBps'")
+
+    if (any(window[2] <= 0 for window in windows)):
+        raise HTTPError(400, "'limit_kBps' must be positive")
+
+    db.set_bandwidth_schedule(windows)
+    pool.update_bandwidth_budget(db)
+
+    return bottle_api_get_bandwidth()
+
 @app.get('/api/video/<video_db_id:re:[0-9]*>')
 def bottle_api_get_video(video_db_id):
-    data = db.get_video(video_db_id)
+    data = reader.get_video(video_db_id)
 
     if (data is None):
         raise HTTPError(404, 'Could not find the requested video.')
 
-    return db.result_to_simple_type(data)
+    return reader.result_to_simple_type(data)
 
 # /update is for backwards compatibility with the original project
 @app.get('/update')
@@ -0,0 +1,41 @@
+import sys
+
+from .db import YtdlDatabase
+from .utils import get_env_override
+
+def open_database():
+    '''
+    Open the server's database for a command line tool.
+    '''
+
+    db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
+
+    # Only safe for a database that no server has used
+    # Otherwise the server is the one to migrate it
+    if (getattr(db, 'is_new_db', False)):
+        db.do_migrations()
+
+    # Tools can't work with an older schema and migrating here could
+    # pull it out from under a server that is still running
+    elif (hasattr(db, 'get_pending_migrations') and len(db.get_pending_migrations()) > 0):
+        sys.exit(f'The database at {db.db_path} is older than this version of ytdl-subscribed. '
+            + 'Start the server once to upgrade it, then run this command again.')
+
+    return db
+
+def run(command, args):
+    '''
+    Run a command line tool by name.
+    '''
+
+    if (command == 'ingest'):
+        from .ingest import main
+    elif (command == 'import'):
+        from .importer import main
+    elif (command == 'verify'):
+        from .integrity import main
+    else:
+        print(f'Unknown command: {command}. Expected ingest, import, or verify', file=sys.stderr)
+        return 2
+
+    return main(args)
@@ -1 +1 @@
-from .db_base import YtdlDatabase, YtdlDatabaseError
+from .db_base import ThreadLocalDatabase, YtdlDatabase, YtdlDatabaseError
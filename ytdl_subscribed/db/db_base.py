@@ -1,13 +1,50 @@
+import itertools
 import json
+import threading
 from abc import ABC, abstractmethod
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 from ..log import log
-from ..utils import get_env_override, get_storage_path, merge_env_db_settings
+from ..utils import (
+    get_env_override,
+    get_storage_path,
+    get_url_site,
+    is_time_of_day,
+    merge_env_db_settings,
+    normalize_url
+)
 
 class YtdlDatabaseError(Exception):
     pass
 
+class ThreadLocalDatabase():
+    '''
+    Stand-in for a database that gives each thread its own connection.
+
+    Attribute access is forwarded to the calling thread's connection
+    which is created on first use.
+    '''
+
+    def __init__(self, db_type, read_only=False):
+
+        self.db_type = db_type
+        self.read_only = read_only
+        self.local = threading.local()
+
+    def get(self):
+        '''
+        Return the connection that belongs to the current thread.
+        '''
+
+        if (not hasattr(self.local, 'db')):
+            self.local.db = YtdlDatabase.factory(self.db_type, read_only=self.read_only)
+
+        return self.local.db
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
 class YtdlDatabase(ABC):
     '''
     Abstract class for database-specific implementations.
@@ -19,10 +56,10 @@ class YtdlDatabase(ABC):
     '''
 
     @staticmethod
-    def factory(db_type):
+    def factory(db_type, read_only=False):
         if (db_type == 'sqlite'):
             from .db_sqlite import YtdlSqliteDatabase
-            return YtdlSqliteDatabase()
+            return YtdlSqliteDatabase(read_only=read_only)
         else:
             raise YtdlDatabaseError(f"Unknown database backend '{db_type}'")
 
@@ -40,6 +77,17 @@ class YtdlDatabase(ABC):
         CHANNEL = 1
         PLAYLIST = 2
 
+    class status:
+        QUEUED = 1
+        IN_PROGRESS = 2
+        FAILED = 3
+        COMPLETE = 4
+
+    class priority:
+        INTERACTIVE = 1
+        REFRESH = 2
+        BACKFILL = 3
+
     def __init__(self):
         '''
         Load settings from the database configuration file at
@@ -48,6 +96,12 @@ class YtdlDatabase(ABC):
 
         self.db = None
         self.db_config = {}
+        self.transaction_depth = 0
+
+        # Settings rarely change but are needed for every download
+        # See get_cached_setting
+        self.settings_cache = {}
+        self.settings_cache_version = None
 
         try:
             with open(get_storage_path('db_config.json')) as f:
@@ -79,6 +133,43 @@ class YtdlDatabase(ABC):
         '''
         pass
 
+    @abstractmethod
+    def _rollback(self):
+        '''
+        Abandon the current transaction.
+        '''
+        pass
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        '''
+        Group all writes made inside the block into a single transaction.
+
+        `_commit` calls made inside the block are deferred until the outermost
+        block exits. Everything is rolled back if the block raises.
+
+        With `immediate`, the transaction starts right away instead of at
+        the first write so that nobody else can write between what the
+        block reads and what it writes.
+        '''
+
+        self.transaction_depth += 1
+
+        try:
+            if (immediate):
+                self._begin()
+
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if (self.transaction_depth == 0):
+                self._rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if (self.transaction_depth == 0):
+            self._commit()
+
     @abstractmethod
     def result_to_simple_type(self, result):
         '''
@@ -87,6 +178,41 @@ class YtdlDatabase(ABC):
         '''
         pass
 
+    def get_settings_version(self):
+        '''
+        Fetch the counter that changes whenever a setting, profile,
+        format, or ytdl option row changes.
+        '''
+
+        # Selecting everything keeps this working on connections that
+        # were opened before the column was added by a migration
+        result = self._execute('''SELECT * FROM setting''')[0]
+
+        if (not 'settings_version' in result.keys()):
+            return None
+
+        return result['settings_version']
+
+    def get_cached_setting(self, key, load):
+        '''
+        Return the value cached under `key`, calling `load` to fill the
+        cache if needed.
+
+        The whole cache is dropped as soon as the settings version changes
+        so cached values never outlive the rows they were built from.
+        '''
+
+        version = self.get_settings_version()
+
+        if (version != self.settings_cache_version):
+            self.settings_cache = {}
+            self.settings_cache_version = version
+
+        if (not key in self.settings_cache):
+            self.settings_cache[key] = load()
+
+        return self.settings_cache[key]
+
     def get_raw_settings(self):
         '''
         Fetch the settings from the database without merging
@@ -107,6 +233,22 @@ class YtdlDatabase(ABC):
         from the environment.
         '''
 
+        # Skip the cache when the overrides should be logged
+        if (not quiet):
+            return self._load_settings(quiet=False)
+
+        return dict(self.get_cached_setting('settings', self._load_settings))
+
+    def check_settings(self):
+        '''
+        Make sure that the stored settings and the overrides from the
+        environment can be used, raising a `YtdlDatabaseError` if not.
+        '''
+
+        self._load_settings(strict=True)
+
+    def _load_settings(self, quiet=True, strict=False):
+
         base_settings = self._execute('''SELECT * FROM setting''')[0]
 
         # Make sure the env override for active profile is taken into account
@@ -119,7 +261,24 @@ class YtdlDatabase(ABC):
         '''
         joined_settings = self._execute(qstring, [active_profile])[0]
 
-        return merge_env_db_settings(joined_settings, quiet=quiet)
+        settings = merge_env_db_settings(joined_settings, quiet=quiet)
+
+        # Windows are compared as strings so anything else would silently
+        # never (or always) match. The settings are checked at startup so
+        # anything that turns up later only turns the window off
+        for key in ('YDL_MAINTENANCE_START', 'YDL_MAINTENANCE_END'):
+            if (key in settings and not is_time_of_day(settings[key])):
+                message = f'{key} must be a time of day like HH:MM, not {settings[key]!r}'
+
+                if (strict):
+                    raise YtdlDatabaseError(message)
+
+                log.warning(f'{message}. Not using a maintenance window')
+                settings['YDL_MAINTENANCE_START'] = None
+                settings['YDL_MAINTENANCE_END'] = None
+                break
+
+        return settings
 
     def get_ydl_options(self):
         '''
@@ -127,7 +286,7 @@ class YtdlDatabase(ABC):
         '''
 
         qstring = '''SELECT * FROM ydl_option'''
-        return self._execute(qstring)
+        return self.get_cached_setting('ydl_options', lambda: self._execute(qstring))
 
     def get_ydl_option(self, env_name):
         '''
@@ -192,6 +351,10 @@ class YtdlDatabase(ABC):
         Defaults to 'best' if no format is found.
         '''
 
+        return self.get_cached_setting(('format', format_id), lambda: self._load_format(format_id))
+
+    def _load_format(self, format_id):
+
         qstring = '''
             SELECT value FROM format WHERE id = ?
         '''
@@ -244,6 +407,44 @@ class YtdlDatabase(ABC):
 
         return self.get_video(video_db_id)
 
+    def get_videos_by_extractor_ids(self, keys):
+        '''
+        Fetch basic video information for many videos at once.
+
+        `keys` is an iterable of `(extractor_name, online_id)` pairs.
+        Returns a dictionary mapping each pair that exists to its row.
+        '''
+
+        # Stay well below the bound parameter limit of older databases
+        max_pairs = 400
+
+        keys = list(keys)
+        found = {}
+
+        for start in range(0, len(keys), max_pairs):
+            batch = keys[start:start + max_pairs]
+            values = ', '.join(['(?, ?)'] * len(batch))
+
+            qstring = f'''
+                WITH wanted (extractor, online_id) AS (VALUES {values})
+                SELECT
+                    e.name AS extractor,
+                    v.online_id AS online_id,
+                    v.id AS id,
+                    v.filepath AS filepath,
+                    v.filepath_exists AS filepath_exists,
+                    v.file_corrupt AS file_corrupt
+                FROM wanted AS w
+                    INNER JOIN extractor AS e ON e.name = w.extractor
+                    INNER JOIN video AS v ON v.extractor_id = e.id AND v.online_id = w.online_id
+            '''
+            result = self._execute(qstring, list(itertools.chain.from_iterable(batch)))
+
+            for row in result:
+                found[(row['extractor'], row['online_id'])] = row
+
+        return found
+
     def get_collection(self, collection_db_id):
         '''
         Fetch collection information for the given collection.
@@ -300,6 +501,83 @@ class YtdlDatabase(ABC):
         '''
         return self._execute(qstring, [video_db_id])
 
+    def get_collection_online_ids(self, collection_db_id):
+        '''
+        Fetch the set of online ids for all videos that belong to
+        the given collection either as its owner or as a member.
+        '''
+
+        qstring = '''
+            SELECT v.online_id FROM video AS v
+            WHERE
+                v.id IN (SELECT video_id FROM video_owner_xref WHERE collection_id = ?)
+                OR v.id IN (SELECT video_id FROM video_collection_xref WHERE collection_id = ?)
+        '''
+        result = self._execute(qstring, [collection_db_id, collection_db_id])
+
+        return set(row['online_id'] for row in result)
+
+    def get_update_schedules(self):
+        '''
+        Fetch the available collection update schedules.
+        '''
+
+        qstring = '''SELECT * FROM update_sched ORDER BY frequency_d'''
+        return self._execute(qstring)
+
+    def set_collection_update_schedule(self, collection_db_id, update_sched_db_id):
+        '''
+        Change how often the given collection is checked for new videos.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE collection SET
+                update_sched_id = ?
+            WHERE
+                id = ?
+        '''
+        self._execute(qstring, [update_sched_db_id, collection_db_id])
+        self._commit()
+
+    @abstractmethod
+    def get_due_collections(self):
+        '''
+        Fetch all collections whose update schedule says they should
+        be checked for new videos and that are not queued already.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
+    @abstractmethod
+    def mark_collection_updated(self, collection_db_id):
+        '''
+        Record that the given collection was just checked for new videos.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
+    def shift_collection_indices(self, collection_db_id, offset):
+        '''
+        Shift the ordering index of every video in the collection by `offset`.
+
+        Used to make room at the front of newest-first collections
+        when new videos are found by an update.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE video_collection_xref SET
+                ordering_index = ordering_index + ?
+            WHERE
+                collection_id = ?
+                AND ordering_index >= 0
+        '''
+        self._execute(qstring, [offset, collection_db_id])
+        self._commit()
+
     def get_extractor(self, extractor_db_id):
         '''
         Fetch the extractor information for the given name.
@@ -330,17 +608,137 @@ class YtdlDatabase(ABC):
 
         return result[0]
 
-    def get_recent_downloads(self, max_count=15):
+    def get_extractor_limits(self):
         '''
-        Fetch up to `max_count` of the latest video downloads.
+        Fetch the dispatch limits of every extractor that has any.
+
+        Returns a dictionary mapping the lowercase extractor name
+        (i.e. the site of the queued jobs) to its limits.
+        '''
+
+        def load():
+            qstring = '''SELECT * FROM extractor_limit'''
+            return {row['name'].lower(): row for row in self._execute(qstring)}
+
+        return self.get_cached_setting('extractor_limits', load)
+
+    def set_extractor_limit(self, name, max_concurrent=None, jobs_per_minute=None, burst=1):
+        '''
+        Change the dispatch limits of an extractor.
+
+        `None` removes the respective limit.
+        '''
+
+        self._begin()
+        qstring = '''
+            INSERT INTO extractor_limit (
+                name,
+                max_concurrent,
+                jobs_per_minute,
+                burst
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                max_concurrent = excluded.max_concurrent,
+                jobs_per_minute = excluded.jobs_per_minute,
+                burst = excluded.burst
+        '''
+        self._execute(qstring, [name, max_concurrent, jobs_per_minute, burst])
+        self._commit()
+
+    def get_bandwidth_schedule(self):
+        '''
+        Fetch the time of day windows that limit the combined download speed.
+        '''
+
+        qstring = '''SELECT * FROM bandwidth_schedule ORDER BY start_time, id'''
+        return self.get_cached_setting('bandwidth_schedule', lambda: self._execute(qstring))
+
+    def set_bandwidth_schedule(self, windows):
         '''
+        Replace the bandwidth schedule with the given list of
+        `(start_time, end_time, limit_kBps)` windows.
+        '''
+
+        self._begin()
+        self._execute('''DELETE FROM bandwidth_schedule''')
 
         qstring = '''
+            INSERT INTO bandwidth_schedule (
+                start_time,
+                end_time,
+                limit_kBps
+            ) VALUES (?, ?, ?)
+        '''
+        for window in windows:
+            self._execute(qstring, list(window))
+
+        self._commit()
+
+    def get_recent_downloads(self, max_count=15, **filters):
+        '''
+        Fetch up to `max_count` of the latest video downloads.
+
+        See `get_video_page` for the available filters.
+        '''
+
+        return self.get_video_page(max_count=max_count, **filters)
+
+    def get_video_page(self, download_status=None, max_count=15, after=None,
+            extractor=None, collection_db_id=None, since=None, before=None):
+        '''
+        Fetch one page of videos ordered from the most to the least recently added.
+
+        Pages are keyed on the video's id so every page costs the same
+        no matter how deep it is. Pass the id of the last video of a
+        page as `after` to fetch the next one, even if it was deleted since.
+
+        :param download_status Only include videos with this `YtdlDatabase.status`
+        :param extractor Only include videos from the extractor with this name
+        :param collection_db_id Only include videos owned by or belonging to this collection
+        :param since Only include videos downloaded at or after this date/time
+        :param before Only include videos downloaded before this date/time
+        '''
+
+        conditions = []
+        parameters = []
+
+        if (not download_status is None):
+            conditions.append('''download_status = ?''')
+            parameters.append(download_status)
+
+        if (not after is None):
+            conditions.append('''id < ?''')
+            parameters.append(after)
+
+        if (not extractor is None):
+            conditions.append('''extractor_id = (SELECT id FROM extractor WHERE name = ?)''')
+            parameters.append(extractor)
+
+        if (not collection_db_id is None):
+            conditions.append('''(uploader_id = ? OR id IN (SELECT video_id FROM video_collection_xref WHERE collection_id = ?))''')
+            parameters += [collection_db_id, collection_db_id]
+
+        if (not since is None):
+            conditions.append('''download_datetime >= ?''')
+            parameters.append(since)
+
+        if (not before is None):
+            conditions.append('''download_datetime < ?''')
+            parameters.append(before)
+
+        where = ''
+        if (len(conditions) > 0):
+            where = 'WHERE ' + ' AND '.join(conditions)
+
+        qstring = f'''
             SELECT * FROM video_details
-            ORDER BY download_datetime DESC
+            {where}
+            ORDER BY id DESC
             LIMIT ?
         '''
-        return self._execute(qstring, [max_count])
+        parameters.append(max_count)
+
+        return self._execute(qstring, parameters)
 
     def get_format_options(self):
         '''
@@ -400,6 +798,25 @@ class YtdlDatabase(ABC):
         '''
         pass
 
+    @abstractmethod
+    def import_videos(self, videos, format_db_id = formats.DEFAULT):
+        '''
+        Insert many videos that were downloaded outside of the server
+        at once, along with their extractors, channels, and channel xrefs.
+
+        Each video is a normalized ytdl info dictionary with the
+        `___filepath` and `___filepath_exists` of its file and the
+        `___download_datetime` to list it under. Videos that already
+        exist only take over the file if their own file is missing.
+        New videos without a file are listed as failed downloads.
+
+        :return The number of videos that were inserted or updated
+
+        ABSTRACT: needs to ignore duplicate conflicts and
+        formats datetime to database specific format
+        '''
+        pass
+
     def insert_video_owner_xref(self, video_id, channel_collection_id):
         '''
         Associate a video with a given channel.
@@ -434,19 +851,76 @@ class YtdlDatabase(ABC):
         '''
         pass
 
-    def get_queued_downloads(self, max_count=15):
+    def get_queued_downloads(self, max_count=15, **filters):
         '''
         Get information about the currently downloading
         videos in the same format as `get_recent_downloads`.
         '''
 
-        qstring = '''
-            SELECT * FROM video_details
-            WHERE queued = 1
-            ORDER BY download_datetime DESC
+        return self.get_video_page(YtdlDatabase.status.QUEUED, max_count=max_count, **filters)
+
+    def get_queued_jobs(self, max_count=15, after=None, extractor=None, collection_db_id=None,
+            since=None, before=None):
+        '''
+        Fetch one page of the jobs in the download queue, whether or not they
+        have started, from the most to the least recently queued.
+
+        Each job comes with the details of its video, which are all `None`
+        for jobs that are only known by their URL (i.e. channels and
+        playlists). Pages are keyed on the job's `job_id` like `get_video_page`.
+
+        See `get_video_page` for the filters. Jobs without a video are
+        matched by their site and the collection they are shared under
+        and are left out when filtering by date.
+        '''
+
+        conditions = []
+        parameters = []
+
+        if (not after is None):
+            conditions.append('''q.id < ?''')
+            parameters.append(after)
+
+        if (not extractor is None):
+            conditions.append('''(v.extractor = ? OR (q.video_id IS NULL AND q.site = lower(?)))''')
+            parameters += [extractor, extractor]
+
+        if (not collection_db_id is None):
+            conditions.append('''(q.collection_id = ? OR v.uploader_id = ?
+                OR v.id IN (SELECT video_id FROM video_collection_xref WHERE collection_id = ?))''')
+            parameters += [collection_db_id, collection_db_id, collection_db_id]
+
+        if (not since is None):
+            conditions.append('''v.download_datetime >= ?''')
+            parameters.append(since)
+
+        if (not before is None):
+            conditions.append('''v.download_datetime < ?''')
+            parameters.append(before)
+
+        where = ''
+        if (len(conditions) > 0):
+            where = 'WHERE ' + ' AND '.join(conditions)
+
+        qstring = f'''
+            SELECT
+                v.*,
+                q.id AS job_id,
+                q.url AS job_url,
+                q.collection_id AS job_collection_id,
+                q.priority AS priority,
+                q.not_before AS not_before,
+                q.claimed_datetime AS claimed_datetime,
+                q.worker_id AS worker_id
+            FROM download_queued AS q
+                LEFT JOIN video_details AS v ON q.video_id = v.id
+            {where}
+            ORDER BY q.id DESC
             LIMIT ?
         '''
-        return self._execute(qstring, [max_count])
+        parameters.append(max_count)
+
+        return self._execute(qstring, parameters)
 
     def clear_download_queue(self):
         '''
@@ -456,6 +930,7 @@ class YtdlDatabase(ABC):
         self._begin()
         qstring = '''DELETE FROM download_queued'''
         self._execute(qstring)
+        self._refresh_download_status()
         self._commit()
 
     def clear_download_in_progress(self):
@@ -466,45 +941,489 @@ class YtdlDatabase(ABC):
         self._begin()
         qstring = '''DELETE FROM download_in_progress'''
         self._execute(qstring)
+        self._refresh_download_status()
         self._commit()
 
-    def mark_download_queued(self, video_db_id, not_before=None):
+    def _refresh_download_status(self, video_db_id=None):
+        '''
+        Recompute the denormalized `download_status` of a video from the
+        queued, in progress, and failed tables.
+
+        If `video_db_id` is `None`, every video that is currently
+        marked as queued or in progress is recomputed.
+
+        Does not commit so that it is part of the caller's transaction.
+        '''
+
+        qstring = '''
+            UPDATE video SET
+                download_status = CASE
+                    WHEN id IN (SELECT video_id FROM download_in_progress) THEN ?
+                    WHEN id IN (SELECT video_id FROM download_queued WHERE video_id IS NOT NULL) THEN ?
+                    WHEN id IN (SELECT video_id FROM download_failed) THEN ?
+                    ELSE ?
+                END
+        '''
+        parameters = [
+            YtdlDatabase.status.IN_PROGRESS,
+            YtdlDatabase.status.QUEUED,
+            YtdlDatabase.status.FAILED,
+            YtdlDatabase.status.COMPLETE
+        ]
+
+        if (video_db_id is None):
+            qstring += ''' WHERE download_status IN (?, ?)'''
+            parameters += [YtdlDatabase.status.QUEUED, YtdlDatabase.status.IN_PROGRESS]
+        else:
+            qstring += ''' WHERE id = ?'''
+            parameters.append(video_db_id)
+
+        self._execute(qstring, parameters)
+
+    def mark_download_queued(self, video_db_id, not_before=None, priority=priority.INTERACTIVE, retry=0,
+            resume=False, collection_db_id=None):
         '''
         Queue a download so that it will be
         downloaded anytime after `not_before`.
+
+        :param retry The number of automatic retries that preceded this one
+        :param resume Continue from any partial file left by an earlier attempt
+            even if the profile doesn't continue downloads
+        :param collection_db_id The collection that the download is shared fairly under
+        '''
+
+        video = self.get_video(video_db_id)
+
+        if (video is None):
+            raise YtdlDatabaseError(f'Cannot queue unknown video: {video_db_id}')
+
+        request_options = {
+            'url': video['url'],
+            'format': video['format_id']
+        }
+
+        if (retry > 0):
+            request_options['retry'] = retry
+        if (resume):
+            request_options['resume'] = True
+
+        return self.queue_job(video['url'], request_options, video_db_id=video_db_id,
+            collection_db_id=collection_db_id, not_before=not_before, priority=priority)
+
+    def queue_job(self, url, request_options, video_db_id=None, collection_db_id=None, not_before=None,
+            priority=priority.INTERACTIVE, attach=True):
+        '''
+        Add a download request to the persistent job queue so that
+        it will be picked up by a worker anytime after `not_before`.
+
+        Due jobs are claimed in order of their `priority` class.
+
+        With `attach`, a request for a URL that is already queued or running
+        with the same options (e.g. a channel submitted twice) is attached to
+        that job instead. A job that hasn't started yet is moved up to the
+        earlier `not_before` and more urgent priority of both requests.
+
+        If a job for `video_db_id` is already queued, its request and
+        `not_before` are updated instead and it keeps the more urgent of
+        both priorities. A job that is running at the time is released
+        so that it runs again rather than being removed once it finishes.
+
+        :return job_db_id for the queued job
         '''
 
         if (not_before is None):
-            not_before = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+            not_before = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        url_key = normalize_url(url)
 
         self._begin()
+
+        # Videos are deduplicated by their id instead
+        if (attach and video_db_id is None):
+
+            job_db_id = self._find_job_to_attach(url_key, request_options)
+
+            if (not job_db_id is None):
+                qstring = '''
+                    UPDATE download_queued SET
+                        not_before = MIN(not_before, ?),
+                        priority = MIN(priority, ?)
+                    WHERE
+                        id = ?
+                        AND claimed_datetime IS NULL
+                '''
+                self._execute(qstring, [not_before, priority, job_db_id])
+                self._commit()
+
+                log.info(f'Attached the request for {url} to job {job_db_id}')
+                return job_db_id
+
         qstring = '''
             INSERT INTO download_queued (
                 video_id,
-                not_before
-            ) VALUES (?, ?)
+                collection_id,
+                url,
+                request_options,
+                not_before,
+                site,
+                priority,
+                url_key
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (video_id) DO UPDATE SET
+                request_options = excluded.request_options,
+                not_before = excluded.not_before,
+                claimed_datetime = NULL,
+                priority = MIN(priority, excluded.priority)
+            RETURNING id
+        '''
+        result = self._execute(qstring, [
+            video_db_id,
+            collection_db_id,
+            url,
+            json.dumps(request_options),
+            not_before,
+            get_url_site(url),
+            priority,
+            url_key
+        ])
+
+        if (not video_db_id is None):
+            self._refresh_download_status(video_db_id)
+
+        self._commit()
+
+        return result[0]['id']
+
+    def _find_job_to_attach(self, url_key, request_options):
+        '''
+        Return the id of a queued or running job for the normalized URL
+        whose options match `request_options` or `None` if there is none.
+        '''
+
+        # Jobs for a known video are deduplicated by their video instead
+        # The video's unique index would otherwise be preferred for
+        # `video_id IS NULL` even though most jobs have no video
+        qstring = '''
+            SELECT id, request_options FROM download_queued INDEXED BY download_queued_url_key_idx
+            WHERE
+                url_key = ?
+                AND video_id IS NULL
+            ORDER BY id
+        '''
+        jobs = self._execute(qstring, [url_key])
+
+        # The URL itself may be written differently
+        # and the number of retries doesn't matter
+        def get_options(options):
+            return {name: value for name, value in options.items() if (not name in ('url', 'retry'))}
+
+        for job in jobs:
+            if (get_options(json.loads(job['request_options'])) == get_options(request_options)):
+                return job['id']
+
+        return None
+
+    def set_job_collection(self, job_db_id, collection_db_id):
+        '''
+        Record the collection that a job turned out to download so that
+        it counts against that collection when jobs are shared fairly.
+
+        Jobs that already belong to a collection keep it.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE download_queued SET
+                collection_id = ?
+            WHERE
+                id = ?
+                AND collection_id IS NULL
+        '''
+        self._execute(qstring, [collection_db_id, job_db_id])
+        self._commit()
+
+    def get_job(self, job_db_id):
+        '''
+        Fetch the queued job with the given id.
+
+        Returns `None` if the job has finished or never existed.
+        '''
+
+        qstring = '''SELECT * FROM download_queued WHERE id = ?'''
+        result = self._execute(qstring, [job_db_id])
+
+        if (len(result) == 0):
+            return None
+
+        return result[0]
+
+    @abstractmethod
+    def claim_next_job(self, lease_s, skip_sites=[], max_priority=None):
+        '''
+        Claim the most urgent job that is due and has not been
+        claimed yet so that no one else picks it up.
+
+        The claim is leased for `lease_s` seconds. Whoever runs the
+        job takes over the lease with `take_job` and keeps it with
+        `renew_job_lease` or the job is released by `reap_expired_jobs`.
+
+        Jobs are taken in order of priority. Within a priority, jobs of
+        collections with the fewest running jobs go first so that one
+        large collection can't hold up the others, then the oldest.
+
+        Jobs for any of the sites in `skip_sites` and jobs less urgent
+        than `max_priority` are left for later.
+
+        Every claim gets a new `claim_token` that the worker has to
+        present to `take_job` and any previous owner is dropped.
+
+        Returns `None` if no job is available.
+
+        ABSTRACT: needs to use date/time functions and claim atomically
+        '''
+        pass
+
+    def get_lease_expires(self, lease_s):
+        '''
+        Return when a lease of `lease_s` seconds that starts now expires.
+        '''
+
+        return (datetime.now() + timedelta(seconds=lease_s)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def take_job(self, job_db_id, claim_token, worker_id, lease_s):
+        '''
+        Make `worker_id` the owner of a claimed job that
+        nobody owns yet for the next `lease_s` seconds.
+
+        `claim_token` is the token of the claim that the job was
+        dispatched with so that a worker that only got the job after
+        it was released and claimed again can't take it.
+
+        Returns `False` if the job was released or belongs to someone else.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE download_queued SET
+                worker_id = ?,
+                lease_expires = ?
+            WHERE
+                id = ?
+                AND claimed_datetime IS NOT NULL
+                AND claim_token = ?
+                AND worker_id IS NULL
+            RETURNING id
+        '''
+        result = self._execute(qstring, [worker_id, self.get_lease_expires(lease_s), job_db_id, claim_token])
+        self._commit()
+
+        return (len(result) > 0)
+
+    def renew_job_lease(self, job_db_id, worker_id, lease_s):
+        '''
+        Extend the lease that `worker_id` holds on a job by `lease_s` seconds.
+
+        Returns `False` if the worker no longer owns the job.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE download_queued SET
+                lease_expires = ?
+            WHERE
+                id = ?
+                AND worker_id = ?
+            RETURNING id
+        '''
+        result = self._execute(qstring, [self.get_lease_expires(lease_s), job_db_id, worker_id])
+        self._commit()
+
+        return (len(result) > 0)
+
+    def reap_expired_jobs(self):
+        '''
+        Release claimed jobs whose lease expired because their worker
+        died or got stuck so that they are picked up again.
+
+        The downloads that the jobs had in progress are ended without
+        recording how so that the caller can count them as failed.
+
+        Returns the released jobs as they were before they were released
+        (i.e. with the `worker_id` and `claim_token` they were claimed with)
+        and a dictionary mapping the id of each job to the ids of the
+        videos that it was downloading.
         '''
-        self._execute(qstring, [video_db_id, not_before])
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        with self.transaction(immediate=True):
+
+            qstring = '''
+                SELECT * FROM download_queued
+                WHERE
+                    claimed_datetime IS NOT NULL
+                    AND lease_expires < ?
+            '''
+            jobs = self._execute(qstring, [now])
+
+            if (len(jobs) == 0):
+                return jobs, {}
+
+            job_db_ids = [job['id'] for job in jobs]
+            qstring = f'''
+                UPDATE download_queued SET
+                    claimed_datetime = NULL,
+                    claim_token = NULL,
+                    worker_id = NULL,
+                    lease_expires = NULL
+                WHERE id IN ({', '.join('?' * len(job_db_ids))})
+            '''
+            self._execute(qstring, job_db_ids)
+
+            qstring = f'''
+                DELETE FROM download_in_progress
+                WHERE job_id IN ({', '.join('?' * len(job_db_ids))})
+                RETURNING video_id, job_id
+            '''
+            interrupted = {job_db_id: [] for job_db_id in job_db_ids}
+            for row in self._execute(qstring, job_db_ids):
+                interrupted[row['job_id']].append(row['video_id'])
+
+        return jobs, interrupted
+
+    def reschedule_job(self, job_db_id, request_options, not_before):
+        '''
+        Change the request and `not_before` of a job that is waiting in the queue.
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE download_queued SET
+                request_options = ?,
+                not_before = ?
+            WHERE
+                id = ?
+                AND claimed_datetime IS NULL
+        '''
+        self._execute(qstring, [json.dumps(request_options), not_before, job_db_id])
+        self._commit()
+
+    def remove_job(self, job_db_id):
+        '''
+        Remove a job that is waiting in the queue.
+        '''
+
+        self._begin()
+        qstring = '''DELETE FROM download_queued WHERE id = ? AND claimed_datetime IS NULL RETURNING video_id'''
+        result = self._execute(qstring, [job_db_id])
+
+        if (len(result) > 0 and not result[0]['video_id'] is None):
+            self._refresh_download_status(result[0]['video_id'])
+
         self._commit()
 
-    def mark_download_started(self, video_db_id):
+    def finish_job(self, job_db_id, worker_id=None):
+        '''
+        Remove a claimed job from the queue once it has been processed.
+
+        Jobs that were queued again while they ran are kept, as are jobs
+        that were handed to another worker if `worker_id` is given.
+        '''
+
+        qstring = '''DELETE FROM download_queued WHERE id = ? AND claimed_datetime IS NOT NULL'''
+        parameters = [job_db_id]
+
+        if (not worker_id is None):
+            qstring += ''' AND worker_id = ?'''
+            parameters.append(worker_id)
+
+        self._begin()
+        result = self._execute(qstring + ''' RETURNING video_id''', parameters)
+
+        if (len(result) > 0 and not result[0]['video_id'] is None):
+            self._refresh_download_status(result[0]['video_id'])
+
+        self._commit()
+
+    def requeue_interrupted_downloads(self):
+        '''
+        Queue the downloads that were still in progress when the server
+        last stopped ahead of everything else so they resume from their
+        partial files, and release the jobs that were running.
+
+        Meant to be called on startup before any job is claimed.
+        '''
+
+        qstring = '''SELECT video_id FROM download_in_progress'''
+        interrupted = self._execute(qstring)
+
+        with self.transaction():
+
+            qstring = '''DELETE FROM download_in_progress'''
+            self._execute(qstring)
+
+            # Jobs claimed by a previous run never finished
+            # Release them so that they are picked up again
+            qstring = '''
+                UPDATE download_queued SET
+                    claimed_datetime = NULL,
+                    claim_token = NULL,
+                    worker_id = NULL,
+                    lease_expires = NULL
+            '''
+            self._execute(qstring)
+
+            for row in interrupted:
+                self.mark_download_queued(row['video_id'], priority=YtdlDatabase.priority.INTERACTIVE, resume=True)
+
+            self._refresh_download_status()
+
+        if (len(interrupted) > 0):
+            log.info(f'Queued {len(interrupted)} interrupted download(s) to resume')
+
+    def get_download_in_progress(self, video_db_id):
+        '''
+        Fetch the in progress record of a video's download,
+        including the job that is downloading it.
+
+        Returns `None` if the video is not being downloaded.
+        '''
+
+        qstring = '''SELECT * FROM download_in_progress WHERE video_id = ?'''
+        result = self._execute(qstring, [video_db_id])
+
+        if (len(result) == 0):
+            return None
+
+        return result[0]
+
+    def mark_download_started(self, video_db_id, job_db_id=None):
         '''
         Add the given video to the download queue.
+
+        :param job_db_id The job that is downloading the video
         '''
 
         self._begin()
         qstring = '''
             INSERT INTO download_in_progress (
-                video_id
-            ) VALUES (?)
+                video_id,
+                job_id
+            ) VALUES (?, ?)
+            ON CONFLICT (video_id) DO UPDATE SET
+                start_datetime = excluded.start_datetime,
+                job_id = excluded.job_id
         '''
-        self._execute(qstring, [video_db_id])
+        self._execute(qstring, [video_db_id, job_db_id])
+        self._refresh_download_status(video_db_id)
         self._commit()
 
-    def mark_download_ended(self, video_db_id, success):
+    def mark_download_ended(self, video_db_id, success, error_text=None, is_permanent=False, retry_count=0):
         '''
         Remove the given video from the download queue
         and mark it as a success or failure.
+
+        See `mark_download_failed` for the failure details.
         '''
 
         self._begin()
@@ -513,25 +1432,40 @@ class YtdlDatabase(ABC):
             WHERE video_id = ?
         '''
         self._execute(qstring, [video_db_id])
-        self._commit()
 
+        # Both refresh the status
         if (not success):
-            self.mark_download_failed(video_db_id)
+            self.mark_download_failed(video_db_id, error_text, is_permanent, retry_count)
         else:
             self.mark_download_unfailed(video_db_id)
 
-    def mark_download_failed(self, video_db_id):
+        self._commit()
+
+    def mark_download_failed(self, video_db_id, error_text=None, is_permanent=False, retry_count=0):
         '''
         Add the given video to the list of failed videos.
+
+        :param error_text The error that ytdl reported
+        :param is_permanent Whether the error means that retrying is pointless
+        :param retry_count The number of automatic retries that also failed
         '''
 
         self._begin()
         qstring = '''
             INSERT INTO download_failed (
-                video_id
-            ) VALUES (?)
-        '''
-        self._execute(qstring, [video_db_id])
+                video_id,
+                error_text,
+                is_permanent,
+                retry_count
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT (video_id) DO UPDATE SET
+                error_text = excluded.error_text,
+                is_permanent = excluded.is_permanent,
+                retry_count = excluded.retry_count,
+                last_fail_datetime = excluded.last_fail_datetime
+        '''
+        self._execute(qstring, [video_db_id, error_text or 'N/A', is_permanent, retry_count])
+        self._refresh_download_status(video_db_id)
         self._commit()
 
     def mark_download_unfailed(self, video_db_id):
@@ -545,6 +1479,24 @@ class YtdlDatabase(ABC):
             WHERE video_id = ?
         '''
         self._execute(qstring, [video_db_id])
+        self._refresh_download_status(video_db_id)
+        self._commit()
+
+    def set_video_filepath(self, video_db_id, filepath):
+        '''
+        Set where a given video's file belongs (i.e. for imported
+        videos that were recorded without one).
+        '''
+
+        self._begin()
+        qstring = '''
+            UPDATE video SET
+                filepath = ?
+            WHERE
+                id = ?
+        '''
+
+        self._execute(qstring, [filepath, video_db_id])
         self._commit()
 
     @abstractmethod
@@ -557,6 +1509,87 @@ class YtdlDatabase(ABC):
         '''
         pass
 
+    @abstractmethod
+    def get_files_to_check(self, max_age_s, max_count):
+        '''
+        Get the `id`, `filepath`, `filepath_exists` and `filepath_last_checked`
+        of up to `max_count` videos whose file wasn't checked in the last
+        `max_age_s` seconds, the longest unchecked first.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
+    @abstractmethod
+    def mark_files_status(self, files):
+        '''
+        Mark many videos' files as present or missing on disk at once.
+
+        `files` is an iterable of `(is_present, video_db_id, filepath,
+        filepath_last_checked)` tuples with the last two as returned by
+        `get_files_to_check`. Videos whose file was moved or checked
+        since then are left alone.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
+    @abstractmethod
+    def mark_file_digest(self, video_db_id, digest, size, mtime_ns):
+        '''
+        Record the checksum of a video's newly downloaded file along
+        with the size and modification time it was taken at.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
+    def get_files_to_verify(self, after_db_id, max_count):
+        '''
+        Get the id, path and recorded checksum of up to `max_count`
+        present files of the videos with an id above `after_db_id`.
+        '''
+
+        qstring = '''
+            SELECT
+                id,
+                filepath,
+                file_sha256,
+                file_size,
+                file_mtime_ns
+            FROM video
+            WHERE
+                id > ?
+                AND filepath IS NOT NULL
+                AND filepath_exists
+            ORDER BY id
+            LIMIT ?
+        '''
+
+        return self._execute(qstring, [after_db_id, max_count])
+
+    def count_corrupt_files(self):
+        '''
+        Count the videos whose file failed verification
+        and hasn't been downloaded again since.
+        '''
+
+        qstring = '''SELECT COUNT(*) AS count FROM video WHERE file_corrupt'''
+        return self._execute(qstring)[0]['count']
+
+    @abstractmethod
+    def mark_files_verified(self, files):
+        '''
+        Record the results of verifying many files at once.
+
+        `files` is an iterable of `(digest, size, mtime_ns, is_corrupt,
+        video_db_id)` tuples. Corrupt files keep the checksum they
+        were downloaded with.
+
+        ABSTRACT: needs to use date/time functions
+        '''
+        pass
+
     def mark_file_present(self, video_db_id):
         '''
         Mark a given video's file as present on disk.
@@ -569,18 +1602,13 @@ class YtdlDatabase(ABC):
         '''
         self.mark_file_status(video_db_id, False)
 
-    def get_failed_downloads(self):
+    def get_failed_downloads(self, max_count=15, **filters):
         '''
         Get infomration about videos that failed to
-        download.
+        download in the same format as `get_recent_downloads`.
         '''
 
-        qstring = '''
-            SELECT * FROM video_details
-            WHERE failed = 1
-            ORDER BY download_datetime DESC
-        '''
-        return self._execute(qstring)
+        return self.get_video_page(YtdlDatabase.status.FAILED, max_count=max_count, **filters)
 
     def _research_insert_uploader(self, ytdl_info):
         '''
@@ -1,6 +1,7 @@
 import itertools
 import os
 import sqlite3
+import threading
 from pprint import pformat
 
 from ..log import log
@@ -8,11 +9,40 @@ from ..utils import get_env_override, get_resource_path, get_storage_path
 from ..version import __version__
 from .db_base import YtdlDatabase, YtdlDatabaseError
 
+# Number of due jobs that claim_next_job balances between collections
+CLAIM_CANDIDATES = 100
+
+def to_sqlite_date(upload_date):
+    '''
+    Convert a ytdl date from YYYYMMDD to SQLite's YYYY-MM-DD.
+    '''
+
+    if (upload_date and len(upload_date) == len('YYYYMMDD')):
+        upload_date = f'{upload_date[0:4]}-{upload_date[4:6]}-{upload_date[6:8]}'
+
+    return upload_date
+
+def _reset_write_lock():
+    '''
+    Give a forked process a write lock of its own, since the one it
+    inherited may have been held by a thread that does not exist in it.
+    '''
+
+    YtdlSqliteDatabase.write_lock = threading.RLock()
+
 class YtdlSqliteDatabase(YtdlDatabase):
 
-    def __init__(self):
+    # Serializes writers within a process so that threads queue up here
+    # rather than spinning in SQLite's busy handler. Each forked worker
+    # gets a fresh one (see _reset_write_lock)
+    write_lock = threading.RLock()
+
+    def __init__(self, read_only=False):
         '''
         Open or create the SQLite database.
+
+        Read-only connections never take the write lock and can
+        be used freely alongside the writers in WAL mode.
         '''
 
         super().__init__()
@@ -24,14 +54,38 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
         log.info(f'Using SQLite database at: {db_path}')
 
+        synchronous = self.db_config.get('YDL_DB_SYNCHRONOUS', 'NORMAL')
+        synchronous = get_env_override('YDL_DB_SYNCHRONOUS', default=synchronous).upper()
+        busy_timeout_ms = self.db_config.get('YDL_DB_BUSY_TIMEOUT_MS', 30000)
+        busy_timeout_ms = int(get_env_override('YDL_DB_BUSY_TIMEOUT_MS', default=busy_timeout_ms))
+
+        if (not synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA')):
+            raise YtdlDatabaseError(f'Invalid YDL_DB_SYNCHRONOUS value: {synchronous}')
+
         self.db_path = db_path
+        self.read_only = read_only
+        self.holds_write_lock = False
         self.is_new_db = not os.path.exists(self.db_path)
-        self.db = sqlite3.connect(db_path)
+
+        # Transactions are managed explicitly by _begin and _commit
+        if (read_only):
+            self.db = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, isolation_level=None)
+        else:
+            self.db = sqlite3.connect(db_path, isolation_level=None)
+
         self.db.row_factory = sqlite3.Row
 
         if (hasattr(log, 'sql')):
             self.db.set_trace_callback(log.sql)
 
+        # WAL lets readers and the writer work at the same time and, with
+        # synchronous=NORMAL, only syncs to disk on checkpoints
+        if (not read_only):
+            self.db.execute('''PRAGMA journal_mode = WAL''')
+
+        self.db.execute(f'''PRAGMA synchronous = {synchronous}''')
+        self.db.execute(f'''PRAGMA busy_timeout = {busy_timeout_ms}''')
+
         # Make sure the settings and any overrides get logged initially
         if (not self.is_new_db):
             log.debug(pformat(self.get_settings(quiet=False)))
@@ -44,22 +98,10 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
             log.debug(pformat(self.get_settings(quiet=False)))
 
-        self._begin()
-        qstring = '''
-            INSERT OR REPLACE INTO download_failed (
-                video_id,
-                last_fail_datetime,
-                error_text
-            ) SELECT
-                video_id,
-                start_datetime,
-                'Server crash or unexpected termination'
-            FROM download_in_progress
-        '''
-        self._execute(qstring)
-        qstring = '''DELETE FROM download_in_progress'''
-        self._execute(qstring)
-        self._commit()
+        self.apply_migrations()
+        self.apply_views()
+
+        self.requeue_interrupted_downloads()
 
         # Make sure version stays up to date
         # TODO: Migrations first
@@ -68,16 +110,109 @@ class YtdlSqliteDatabase(YtdlDatabase):
         self._execute(qstring, [__version__])
         self._commit()
 
+    def get_pending_migrations(self):
+        '''
+        Return the `(version, filename)` of every migration script
+        that is newer than the database, oldest first.
+
+        The schema version is tracked using SQLite's `user_version` pragma.
+        Scripts live in `db/sqlite-migrations/` and are named `<version>-<description>.sql`.
+        '''
+
+        current_version = self._execute('''PRAGMA user_version''')[0][0]
+        migration_dir = get_resource_path('db/sqlite-migrations')
+
+        migrations = ((int(filename.split('-')[0]), filename) for filename in os.listdir(migration_dir))
+
+        return sorted(migration for migration in migrations if (migration[0] > current_version))
+
+    def apply_migrations(self):
+        '''
+        Apply any migration scripts that are newer than the database.
+        '''
+
+        migration_dir = get_resource_path('db/sqlite-migrations')
+
+        for version, filename in self.get_pending_migrations():
+
+            log.info(f'Applying database migration {filename}')
+
+            with open(os.path.join(migration_dir, filename), mode='r') as f:
+                qstring = f.read()
+
+            # Bump the version inside the same transaction so that
+            # a failed migration is never marked as applied
+            self.db.executescript(f'''
+                BEGIN;
+                {qstring}
+                PRAGMA user_version = {version};
+                COMMIT;
+            ''')
+
+    def apply_views(self):
+        '''
+        (Re)create all views so that they match the current schema.
+        '''
+
+        with open(get_resource_path('db/sqlite-views.sql'), mode='r') as f:
+            qstring = f.read()
+
+        self._begin()
+        self.db.executescript(qstring)
+        self._commit()
+
     def _begin(self):
-        # Do nothing since transactions are automatic on write with sqlite3
-        pass
+
+        if (self.read_only or self.db.in_transaction):
+            return
+
+        # Take the write lock up front so that concurrent writers wait on
+        # each other instead of failing to upgrade a read transaction
+        YtdlSqliteDatabase.write_lock.acquire()
+        self.holds_write_lock = True
+
+        try:
+            self.db.execute('''BEGIN IMMEDIATE''')
+        except Exception:
+            self._release_write_lock()
+            raise
 
     def _execute(self, qstring, parameters=[]):
-        cursor = self.db.execute(qstring, parameters)
-        return cursor.fetchall()
+
+        try:
+            cursor = self.db.execute(qstring, parameters)
+            return cursor.fetchall()
+        except Exception:
+            # Units of work roll back on their own
+            if (self.transaction_depth == 0):
+                self._rollback()
+            raise
 
     def _commit(self):
-        self.db.commit()
+
+        # Writes made inside a unit of work are committed when it ends
+        if (self.transaction_depth > 0):
+            return
+
+        try:
+            if (self.db.in_transaction):
+                self.db.commit()
+        finally:
+            self._release_write_lock()
+
+    def _rollback(self):
+
+        try:
+            if (self.db.in_transaction):
+                self.db.rollback()
+        finally:
+            self._release_write_lock()
+
+    def _release_write_lock(self):
+
+        if (self.holds_write_lock):
+            self.holds_write_lock = False
+            YtdlSqliteDatabase.write_lock.release()
 
     def result_to_simple_type(self, result):
 
@@ -130,25 +265,26 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
         self._begin()
         qstring = '''
-            INSERT OR IGNORE INTO extractor (
+            INSERT INTO extractor (
                 name,
                 alt_name
-            ) VALUES (?, ?);
+            ) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                name = excluded.name
+            RETURNING id
         '''
-        self._execute(qstring, [
+        result = self._execute(qstring, [
             ytdl_info['extractor_key'],
             ytdl_info['extractor']
         ])
 
         self._commit()
 
-        extractor = self.get_extractor_by_name(ytdl_info['extractor_key'])
-
-        if (extractor is None):
+        if (len(result) == 0):
             log.error(f'Could not retrieve extractor after insertion!')
             raise YtdlDatabaseError('Extractor insertion not found')
 
-        return extractor['id']
+        return result[0]['id']
 
     def insert_collection(self, ytdl_info, collection_type):
         '''
@@ -157,9 +293,10 @@ class YtdlSqliteDatabase(YtdlDatabase):
         :return collection_db_id for the inserted or already existing collection
         '''
 
+        # The no-op update makes an existing collection return its id
         self._begin()
         qstring = '''
-            INSERT OR IGNORE INTO collection (
+            INSERT INTO collection (
                 online_id,
                 online_title,
                 custom_title,
@@ -168,12 +305,15 @@ class YtdlSqliteDatabase(YtdlDatabase):
                 extractor_id
             ) VALUES (?, ?, ?, ?, ?,
                 (SELECT id FROM extractor WHERE name = ?)
-            );
+            )
+            ON CONFLICT (online_id, extractor_id) DO UPDATE SET
+                online_id = excluded.online_id
+            RETURNING id
         '''
 
         if (collection_type == YtdlDatabase.collection.CHANNEL):
             online_id = ytdl_info['uploader_id']
-            self._execute(qstring, [
+            result = self._execute(qstring, [
                 online_id,
                 ytdl_info['uploader'],
                 ytdl_info['uploader'],
@@ -184,7 +324,7 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
         elif (collection_type == YtdlDatabase.collection.PLAYLIST):
             online_id = ytdl_info['id']
-            self._execute(qstring, [
+            result = self._execute(qstring, [
                 online_id,
                 ytdl_info['title'],
                 ytdl_info['title'],
@@ -198,13 +338,11 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
         self._commit()
 
-        collection = self.get_collection_by_extractor_id(ytdl_info['extractor_key'], online_id)
-
-        if (collection is None):
+        if (len(result) == 0):
             log.error(f'Could not retrieve collection after insertion!')
             raise YtdlDatabaseError('Collection insertion not found')
 
-        return collection['id']
+        return result[0]['id']
 
     def insert_video(self, ytdl_info, format_db_id = YtdlDatabase.formats.DEFAULT):
         '''
@@ -228,20 +366,17 @@ class YtdlSqliteDatabase(YtdlDatabase):
             VALUES (?,
                 (SELECT id FROM extractor WHERE name = ?),
             ?, ?, ?, ?, ?, ?)
+            RETURNING id
         '''
 
-        # Convert date to match SQLite format
-        # From YYYYMMDD to YYYY-MM-DD
-        upload_date = ytdl_info['upload_date']
-        if (upload_date and len(upload_date) == len('YYYYMMDD')):
-            upload_date = f'{upload_date[0:4]}-{upload_date[4:6]}-{upload_date[6:8]}'
+        upload_date = to_sqlite_date(ytdl_info['upload_date'])
 
         # Grab the filepath that we snuck in
         filepath = ytdl_info['___filepath']
 
         log.debug(f'Populated output template: {filepath}')
 
-        self._execute(qstring, [
+        result = self._execute(qstring, [
             ytdl_info['id'],
             ytdl_info['extractor_key'],
             ytdl_info['webpage_url'],
@@ -252,17 +387,141 @@ class YtdlSqliteDatabase(YtdlDatabase):
             filepath
         ])
 
-        self._commit()
-
         self._research_insert_uploader(ytdl_info)
 
-        video = self.get_video_by_extractor_id(ytdl_info['extractor_key'], ytdl_info['id'])
+        self._commit()
 
-        if (video is None):
+        if (len(result) == 0):
             log.error(f'Could not retrieve video after insertion!')
             raise YtdlDatabaseError('Video insertion not found')
 
-        return video['id']
+        return result[0]['id']
+
+    def import_videos(self, videos, format_db_id = YtdlDatabase.formats.DEFAULT):
+
+        videos = list(videos)
+
+        self._begin()
+
+        qstring = '''
+            INSERT INTO extractor (
+                name,
+                alt_name
+            ) VALUES (?, ?)
+            ON CONFLICT (name) DO NOTHING
+        '''
+        extractors = {video['extractor_key']: video['extractor'] or video['extractor_key'] for video in videos}
+        self.db.executemany(qstring, extractors.items())
+
+        # Videos without an uploader don't get a channel
+        qstring = '''
+            INSERT INTO collection (
+                online_id,
+                online_title,
+                custom_title,
+                url,
+                type_id,
+                extractor_id
+            ) VALUES (?, ?, ?, ?, ?,
+                (SELECT id FROM extractor WHERE name = ?)
+            )
+            ON CONFLICT (online_id, extractor_id) DO NOTHING
+        '''
+        channels = {}
+        for video in videos:
+            if (video['uploader_id']):
+                uploader = video['uploader'] or video['uploader_id']
+                channels[(video['uploader_id'], video['extractor_key'])] = (
+                    video['uploader_id'],
+                    uploader,
+                    uploader,
+                    video['uploader_url'],
+                    YtdlDatabase.collection.CHANNEL,
+                    video['extractor_key']
+                )
+        self.db.executemany(qstring, channels.values())
+
+        qstring = '''
+            INSERT INTO video (
+                online_id,
+                extractor_id,
+                url,
+                title,
+                format_id,
+                duration_s,
+                upload_date,
+                filepath,
+                filepath_exists,
+                filepath_last_checked,
+                download_datetime,
+                download_status
+            )
+            VALUES (?,
+                (SELECT id FROM extractor WHERE name = ?),
+            ?, ?, ?, ?, ?, ?, ?,
+                datetime('now', 'localtime'),
+                COALESCE(?, datetime('now', 'localtime')),
+                ?
+            )
+            ON CONFLICT (online_id, extractor_id) DO UPDATE SET
+                filepath = excluded.filepath,
+                filepath_exists = excluded.filepath_exists,
+                filepath_last_checked = excluded.filepath_last_checked
+            WHERE
+                NOT COALESCE(video.filepath_exists, 0)
+                AND excluded.filepath_exists
+        '''
+        cursor = self.db.executemany(qstring, ((
+            video['id'],
+            video['extractor_key'],
+            video['webpage_url'],
+            video['title'],
+            format_db_id,
+            video['duration'],
+            to_sqlite_date(video['upload_date']),
+            video['___filepath'],
+            video['___filepath_exists'],
+            video['___download_datetime'],
+            YtdlDatabase.status.COMPLETE if video['___filepath_exists'] else YtdlDatabase.status.FAILED
+        ) for video in videos))
+        num_imported = cursor.rowcount
+
+        # Videos that were just added without their file are listed as failed
+        # with a reason so that they can be downloaded again from there
+        qstring = '''
+            INSERT INTO download_failed (
+                video_id,
+                error_text
+            ) SELECT v.id, ? FROM extractor AS e
+                INNER JOIN video AS v ON v.extractor_id = e.id AND v.online_id = ?
+            WHERE
+                e.name = ?
+                AND v.download_status = ?
+            ON CONFLICT (video_id) DO NOTHING
+        '''
+        self.db.executemany(qstring, (
+            ('The file was missing when the video was imported', video['id'], video['extractor_key'], YtdlDatabase.status.FAILED)
+            for video in videos if (not video['___filepath_exists'])
+        ))
+
+        qstring = '''
+            INSERT INTO video_owner_xref (
+                video_id,
+                collection_id
+            ) SELECT v.id, c.id FROM extractor AS e
+                INNER JOIN video AS v ON v.extractor_id = e.id AND v.online_id = ?
+                INNER JOIN collection AS c ON c.extractor_id = e.id AND c.online_id = ?
+            WHERE e.name = ?
+            ON CONFLICT (video_id) DO NOTHING
+        '''
+        self.db.executemany(qstring, (
+            (video['id'], video['uploader_id'], video['extractor_key'])
+            for video in videos if (video['uploader_id'])
+        ))
+
+        self._commit()
+
+        return num_imported
 
     def insert_video_collection_xref(self, video_id, collection_id, ordered_index=-1):
 
@@ -305,6 +564,84 @@ class YtdlSqliteDatabase(YtdlDatabase):
 
         self._commit()
 
+    def get_due_collections(self):
+
+        qstring = '''
+            SELECT c.* FROM collection AS c
+                INNER JOIN update_sched AS u ON c.update_sched_id = u.id
+            WHERE
+                u.frequency_d > 0
+                AND c.url IS NOT NULL
+                AND datetime(c.last_update_datetime, '+' || u.frequency_d || ' days') <= datetime('now', 'localtime')
+                AND c.id NOT IN (
+                    SELECT collection_id FROM download_queued
+                    WHERE collection_id IS NOT NULL
+                )
+            ORDER BY c.last_update_datetime
+        '''
+        return self._execute(qstring)
+
+    def mark_collection_updated(self, collection_db_id):
+
+        self._begin()
+        qstring = '''
+            UPDATE collection SET
+                last_update_datetime = datetime('now', 'localtime')
+            WHERE
+                id = ?
+        '''
+        self._execute(qstring, [collection_db_id])
+        self._commit()
+
+    def claim_next_job(self, lease_s, skip_sites=[], max_priority=None):
+
+        skip_sites = list(skip_sites)
+
+        if (max_priority is None):
+            max_priority = YtdlDatabase.priority.BACKFILL
+
+        # Fairness is only decided among the first due jobs in index
+        # order so that claiming stays cheap however long the queue is
+        self._begin()
+        qstring = f'''
+            UPDATE download_queued SET
+                claimed_datetime = datetime('now', 'localtime'),
+                claim_token = lower(hex(randomblob(8))),
+                worker_id = NULL,
+                lease_expires = datetime('now', 'localtime', ?)
+            WHERE id = (
+                SELECT c.id FROM (
+                    SELECT id, collection_id, priority, not_before FROM download_queued
+                    WHERE
+                        claimed_datetime IS NULL
+                        AND priority <= ?
+                        AND not_before <= datetime('now', 'localtime')
+                        AND COALESCE(site, '') NOT IN ({', '.join('?' * len(skip_sites))})
+                    ORDER BY priority, not_before, id
+                    LIMIT ?
+                ) AS c
+                ORDER BY
+                    c.priority,
+                    (
+                        SELECT COUNT(*) FROM download_queued AS r
+                        WHERE
+                            r.collection_id = c.collection_id
+                            AND r.claimed_datetime IS NOT NULL
+                    ),
+                    c.not_before,
+                    c.id
+                LIMIT 1
+            )
+            RETURNING *
+        '''
+        result = self._execute(qstring, [f'+{lease_s} seconds', max_priority] + skip_sites + [CLAIM_CANDIDATES])
+        self._commit()
+
+        if (len(result) == 0):
+            return None
+
+        return result[0]
+
     def mark_file_status(self, video_db_id, is_present):
 
         self._begin()
@@ -322,7 +659,99 @@ class YtdlSqliteDatabase(YtdlDatabase):
         ])
         self._commit()
 
+    def get_files_to_check(self, max_age_s, max_count):
+
+        qstring = '''
+            SELECT
+                id,
+                filepath,
+                filepath_exists,
+                filepath_last_checked
+            FROM video
+            WHERE
+                filepath IS NOT NULL
+                AND (
+                    filepath_last_checked IS NULL
+                    OR filepath_last_checked < datetime('now', 'localtime', ?)
+                )
+            ORDER BY filepath_last_checked
+            LIMIT ?
+        '''
+
+        return self._execute(qstring, [f'-{max_age_s} seconds', max_count])
+
+    def mark_files_status(self, files):
+
+        self._begin()
+        qstring = '''
+            UPDATE video SET
+                filepath_exists = ?,
+                filepath_last_checked = datetime('now', 'localtime')
+            WHERE
+                id = ?
+                AND filepath IS ?
+                AND filepath_last_checked IS ?
+        '''
+
+        try:
+            self.db.executemany(qstring, files)
+        except Exception:
+            if (self.transaction_depth == 0):
+                self._rollback()
+            raise
+
+        self._commit()
+
+    def mark_file_digest(self, video_db_id, digest, size, mtime_ns):
+
+        self._begin()
+        qstring = '''
+            UPDATE video SET
+                file_sha256 = ?,
+                file_size = ?,
+                file_mtime_ns = ?,
+                file_verified_datetime = datetime('now', 'localtime'),
+                file_corrupt = 0
+            WHERE
+                id = ?
+        '''
+
+        self._execute(qstring, [digest, size, mtime_ns, video_db_id])
+        self._commit()
+
+    def mark_files_verified(self, files):
+
+        self._begin()
+        qstring = '''
+            UPDATE video SET
+                file_sha256 = ?,
+                file_size = ?,
+                file_mtime_ns = ?,
+                file_verified_datetime = datetime('now', 'localtime'),
+                file_corrupt = ?
+            WHERE
+                id = ?
+        '''
+
+        try:
+            self.db.executemany(qstring, files)
+        except Exception:
+            if (self.transaction_depth == 0):
+                self._rollback()
+            raise
+
+        self._commit()
+
     def __del__(self):
 
         if (self.db):
-            self.db.close()
+            try:
+                self.db.close()
+            except sqlite3.ProgrammingError:
+                # Connections owned by finished helper threads are
+                # collected elsewhere and are closed on deallocation anyway
+                pass
+
+# Not available on Windows, which spawns its workers instead of forking
+if (hasattr(os, 'register_at_fork')):
+    os.register_at_fork(after_in_child=_reset_write_lock)
@@ -299,70 +299,6 @@ CREATE TABLE IF NOT EXISTS download_failed (
     PRIMARY KEY (video_id)
 );
 
-
--- Views
-
-DROP VIEW IF EXISTS video_details;
-CREATE VIEW video_details AS
-    SELECT
-        v.id AS id,
-        v.online_id AS online_id,
-        v.title AS title,
-        v.url AS url,
-        v.duration_s AS duration_s,
-        v.upload_date AS upload_date,
-        v.download_datetime AS download_datetime,
-        v.filepath AS filepath,
-        v.filepath_exists AS filepath_exists,
-        v.filepath_last_checked AS filepath_last_checked,
-        c.id AS uploader_id,
-        c.online_title AS uploader_name,
-        c.url AS uploader_url,
-        e.id AS extractor_id,
-        e.name AS extractor,
-        f.id AS format_id,
-        f.label AS format_name,
-        f.value AS format,
-        (v.id IN (SELECT video_id FROM download_queued)) AS queued,
-        (v.id IN (SELECT video_id FROM download_in_progress)) AS in_progress,
-        (v.id IN (SELECT video_id FROM download_failed)) AS failed
-    FROM video AS v
-        LEFT JOIN extractor AS e ON v.extractor_id = e.id
-        LEFT JOIN format AS f ON v.format_id = f.id
-        LEFT JOIN video_owner_xref AS vo ON v.id = vo.video_id
-        LEFT JOIN collection AS c ON vo.collection_id = c.id
-    ORDER BY download_datetime DESC
-;
-
-DROP VIEW IF EXISTS collection_details;
-CREATE VIEW collection_details AS
-    SELECT
-        c.id AS id,
-        c.online_id AS online_id,
-        c.online_title AS online_title,
-        c.custom_title AS title,
-        c.url AS url,
-        c.first_download_datetime AS first_download_datetime,
-        c.last_download_datetime AS last_download_datetime,
-        c.last_update_datetime AS last_update_datetime,
-        ct.id AS type_id,
-        ct.name AS type,
-        cs.id AS setting_id,
-        cs.title AS setting_title,
-        cs.description AS setting_description,
-        u.id AS schedule_id,
-        u.name AS schedule_name,
-        u.description AS schedule_description,
-        e.id AS extractor_id,
-        e.name AS extractor
-    FROM collection AS c
-        LEFT JOIN collection_type AS ct ON c.type_id = ct.id
-        LEFT JOIN collection_setting AS cs ON c.setting_id = cs.id
-        LEFT JOIN update_sched AS u ON c.update_sched_id = u.id
-        LEFT JOIN extractor AS e ON c.extractor_id = e.id
-    ORDER BY title DESC
-;
-
 -- Testing/Research
 
 CREATE TABLE IF NOT EXISTS _uploader_alternative (
@@ -0,0 +1,36 @@
+-- Turn download_queued into a persistent job queue
+--
+-- Jobs are URL submissions that may not have been resolved
+-- to a video yet, so video_id becomes optional and the
+-- request itself is stored alongside it
+
+DROP VIEW IF EXISTS video_details;
+
+CREATE TABLE download_queued_new (
+    id INTEGER PRIMARY KEY,
+    video_id INTEGER REFERENCES video(id),
+    url TEXT NOT NULL,
+    request_options TEXT NOT NULL DEFAULT '{}',     -- JSON
+    queued_datetime TEXT DEFAULT (datetime('now', 'localtime')),
+    not_before TEXT DEFAULT (datetime('now', 'localtime')),
+    claimed_datetime TEXT,
+    UNIQUE (video_id)
+);
+
+INSERT INTO download_queued_new (
+    video_id,
+    url,
+    request_options,
+    not_before
+) SELECT
+    q.video_id,
+    v.url,
+    json_object('url', v.url, 'format', v.format_id),
+    q.not_before
+FROM download_queued AS q
+    INNER JOIN video AS v ON q.video_id = v.id;
+
+DROP TABLE download_queued;
+ALTER TABLE download_queued_new RENAME TO download_queued;
+
+CREATE INDEX download_queued_claim_idx ON download_queued (claimed_datetime, not_before);
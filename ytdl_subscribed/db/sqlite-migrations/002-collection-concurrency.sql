@@ -0,0 +1,3 @@
+-- Number of entries from a collection that are downloaded at the same time
+
+ALTER TABLE collection_setting ADD COLUMN download_concurrency INTEGER DEFAULT 3 CHECK (download_concurrency > 0);
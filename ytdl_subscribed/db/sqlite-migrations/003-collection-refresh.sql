@@ -0,0 +1,8 @@
+-- Remember which collection a queued job refreshes so that
+-- a collection is never queued for an update twice
+
+ALTER TABLE download_queued ADD COLUMN collection_id INTEGER REFERENCES collection(id);
+
+CREATE INDEX download_queued_collection_idx ON download_queued (collection_id);
+CREATE INDEX video_collection_xref_collection_idx ON video_collection_xref (collection_id);
+CREATE INDEX video_owner_xref_collection_idx ON video_owner_xref (collection_id);
@@ -0,0 +1,30 @@
+-- Store the download status on the video itself so that listing
+-- queued/in progress/failed videos doesn't need a subquery per row
+
+CREATE TABLE download_status (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    UNIQUE (name)
+);
+INSERT INTO download_status (id, name)
+    VALUES
+        (1, 'Queued'),
+        (2, 'In progress'),
+        (3, 'Failed'),
+        (4, 'Complete')
+;
+
+ALTER TABLE video ADD COLUMN download_status INTEGER NOT NULL DEFAULT 4 REFERENCES download_status(id);
+
+-- Precedence must match YtdlDatabase._refresh_download_status
+UPDATE video SET
+    download_status = CASE
+        WHEN id IN (SELECT video_id FROM download_in_progress) THEN 2
+        WHEN id IN (SELECT video_id FROM download_queued WHERE video_id IS NOT NULL) THEN 1
+        WHEN id IN (SELECT video_id FROM download_failed) THEN 3
+        ELSE 4
+    END
+;
+
+CREATE INDEX video_status_datetime_idx ON video (download_status, download_datetime);
+CREATE INDEX video_datetime_idx ON video (download_datetime);
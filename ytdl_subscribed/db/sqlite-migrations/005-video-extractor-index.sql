@@ -0,0 +1,3 @@
+-- Keep per-extractor listings bounded to one page of index entries
+
+CREATE INDEX video_extractor_datetime_idx ON video (extractor_id, download_datetime);
@@ -0,0 +1,49 @@
+-- Counter that changes whenever anything used to build the ytdl options
+-- changes so that connections know when their cached settings are stale
+
+ALTER TABLE setting ADD COLUMN settings_version INTEGER NOT NULL DEFAULT 0;
+
+CREATE TRIGGER setting_version_update AFTER UPDATE ON setting
+    WHEN NEW.settings_version IS OLD.settings_version
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+
+CREATE TRIGGER profile_setting_version_insert AFTER INSERT ON profile_setting
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER profile_setting_version_update AFTER UPDATE ON profile_setting
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER profile_setting_version_delete AFTER DELETE ON profile_setting
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+
+CREATE TRIGGER format_version_insert AFTER INSERT ON format
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER format_version_update AFTER UPDATE ON format
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER format_version_delete AFTER DELETE ON format
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+
+CREATE TRIGGER ydl_option_version_insert AFTER INSERT ON ydl_option
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER ydl_option_version_update AFTER UPDATE ON ydl_option
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER ydl_option_version_delete AFTER DELETE ON ydl_option
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
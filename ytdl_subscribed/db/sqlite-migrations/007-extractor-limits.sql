@@ -0,0 +1,29 @@
+-- Per-site limits that the dispatcher enforces when claiming jobs
+
+-- Site of the extractor that will handle the job's URL (e.g. youtube)
+-- so the dispatcher can skip jobs for sites that are at their limit
+ALTER TABLE download_queued ADD COLUMN site TEXT;
+
+CREATE TABLE extractor_limit (
+    name TEXT PRIMARY KEY,      -- extractor.name (e.g. Youtube), matched to the site ignoring case
+    max_concurrent INTEGER CHECK (max_concurrent IS NULL OR max_concurrent > 0),
+    jobs_per_minute REAL CHECK (jobs_per_minute IS NULL OR jobs_per_minute > 0),
+    burst INTEGER NOT NULL DEFAULT 1 CHECK (burst > 0)
+);
+INSERT INTO extractor_limit (name, max_concurrent, jobs_per_minute, burst)
+    VALUES
+        ('Youtube', 2, 10, 5)
+;
+
+CREATE TRIGGER extractor_limit_version_insert AFTER INSERT ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER extractor_limit_version_update AFTER UPDATE ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER extractor_limit_version_delete AFTER DELETE ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
@@ -0,0 +1,23 @@
+-- Time of day windows that cap the combined download speed of all workers
+-- Windows where start_time > end_time wrap around midnight
+-- No limit applies outside of every window
+
+CREATE TABLE bandwidth_schedule (
+    id INTEGER PRIMARY KEY,
+    start_time TEXT NOT NULL CHECK (time(start_time) IS NOT NULL),    -- HH:MM, local time
+    end_time TEXT NOT NULL CHECK (time(end_time) IS NOT NULL),
+    limit_kBps INTEGER NOT NULL CHECK (limit_kBps > 0)
+);
+
+CREATE TRIGGER bandwidth_schedule_version_insert AFTER INSERT ON bandwidth_schedule
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER bandwidth_schedule_version_update AFTER UPDATE ON bandwidth_schedule
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER bandwidth_schedule_version_delete AFTER DELETE ON bandwidth_schedule
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
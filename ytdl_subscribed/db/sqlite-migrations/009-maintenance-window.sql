@@ -0,0 +1,5 @@
+-- Daily window (local time) that deferred jobs wait for
+-- Windows where the start is after the end wrap around midnight
+
+ALTER TABLE setting ADD COLUMN YDL_MAINTENANCE_START TEXT NOT NULL DEFAULT '01:00' CHECK (time(YDL_MAINTENANCE_START) IS NOT NULL);
+ALTER TABLE setting ADD COLUMN YDL_MAINTENANCE_END TEXT NOT NULL DEFAULT '06:00' CHECK (time(YDL_MAINTENANCE_END) IS NOT NULL);
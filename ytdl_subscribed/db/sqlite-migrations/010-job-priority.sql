@@ -0,0 +1,21 @@
+-- Priority classes for queued jobs (lower ids are claimed first)
+
+CREATE TABLE job_priority (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    UNIQUE (name)
+);
+INSERT INTO job_priority (id, name)
+    VALUES
+        (1, 'Interactive'),
+        (2, 'Refresh'),
+        (3, 'Backfill')
+;
+
+ALTER TABLE download_queued ADD COLUMN priority INTEGER NOT NULL DEFAULT 1 REFERENCES job_priority(id);
+
+-- Only collection updates were queued with a collection so far
+UPDATE download_queued SET priority = 2 WHERE collection_id IS NOT NULL;
+
+DROP INDEX download_queued_claim_idx;
+CREATE INDEX download_queued_claim_idx ON download_queued (claimed_datetime, priority, not_before);
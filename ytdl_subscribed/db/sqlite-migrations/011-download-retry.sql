@@ -0,0 +1,5 @@
+-- Failed downloads keep the reason they failed and how often they were retried
+-- Permanent failures (e.g. removed or private videos) are not retried automatically
+
+ALTER TABLE download_failed ADD COLUMN retry_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE download_failed ADD COLUMN is_permanent INTEGER NOT NULL DEFAULT 0 CHECK (is_permanent = 0 OR is_permanent = 1);
@@ -0,0 +1,11 @@
+-- Claimed jobs are leased to the worker process that runs them
+-- Workers renew the lease while they make progress so that the jobs of
+-- workers that died or got stuck are released once their lease expires
+
+ALTER TABLE download_queued ADD COLUMN worker_id TEXT;      -- hostname:pid
+ALTER TABLE download_queued ADD COLUMN lease_expires TEXT;
+
+-- Job that is downloading the video so that it can
+-- be resumed if the job's worker goes away
+-- Not a reference since jobs are removed once they finish
+ALTER TABLE download_in_progress ADD COLUMN job_id INTEGER;
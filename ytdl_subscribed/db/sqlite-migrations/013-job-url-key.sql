@@ -0,0 +1,7 @@
+-- Normalized URL of each job so that repeated submissions
+-- of the same URL can be attached to the job already queued
+-- Jobs queued before this are left alone
+
+ALTER TABLE download_queued ADD COLUMN url_key TEXT;
+
+CREATE INDEX download_queued_url_key_idx ON download_queued (url_key);
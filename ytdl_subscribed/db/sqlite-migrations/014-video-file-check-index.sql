@@ -0,0 +1,4 @@
+-- Let the file reconciler find the videos that were checked the longest ago
+-- Videos without a file are never checked
+
+CREATE INDEX video_filepath_last_checked_idx ON video (filepath_last_checked) WHERE filepath IS NOT NULL;
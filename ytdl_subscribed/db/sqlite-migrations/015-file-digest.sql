@@ -0,0 +1,8 @@
+-- Checksum of each downloaded file so that corruption can be detected
+-- The size and mtime it was taken at let verification skip unchanged files
+
+ALTER TABLE video ADD COLUMN file_sha256 TEXT;
+ALTER TABLE video ADD COLUMN file_size INTEGER;
+ALTER TABLE video ADD COLUMN file_mtime_ns INTEGER;
+ALTER TABLE video ADD COLUMN file_verified_datetime TEXT;
+ALTER TABLE video ADD COLUMN file_corrupt INTEGER NOT NULL DEFAULT 0 CHECK (file_corrupt = 0 OR file_corrupt = 1);
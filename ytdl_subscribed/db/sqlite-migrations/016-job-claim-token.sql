@@ -0,0 +1,4 @@
+-- Token that identifies each claim of a job so that a worker that
+-- got a job after its claim expired can't take it from the next claim
+
+ALTER TABLE download_queued ADD COLUMN claim_token TEXT;
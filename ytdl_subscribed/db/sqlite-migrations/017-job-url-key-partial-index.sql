@@ -0,0 +1,6 @@
+-- Only jobs without a video are attached to by their URL
+-- so only they need to be indexed by it
+
+DROP INDEX download_queued_url_key_idx;
+
+CREATE INDEX download_queued_url_key_idx ON download_queued (url_key) WHERE video_id IS NULL;
@@ -0,0 +1,33 @@
+-- Match extractor limits to names ignoring case like the dispatcher does
+-- so that e.g. Youtube and youtube can't both have a limit
+-- The column's collation can only be changed by rebuilding the table
+-- Of limits that only differ in case, the last one set is kept
+
+CREATE TABLE extractor_limit_nocase (
+    name TEXT PRIMARY KEY COLLATE NOCASE,   -- extractor.name (e.g. Youtube), matched to the site ignoring case
+    max_concurrent INTEGER CHECK (max_concurrent IS NULL OR max_concurrent > 0),
+    jobs_per_minute REAL CHECK (jobs_per_minute IS NULL OR jobs_per_minute > 0),
+    burst INTEGER NOT NULL DEFAULT 1 CHECK (burst > 0)
+);
+INSERT INTO extractor_limit_nocase (name, max_concurrent, jobs_per_minute, burst)
+    SELECT name, max_concurrent, jobs_per_minute, burst FROM extractor_limit
+    WHERE rowid IN (SELECT MAX(rowid) FROM extractor_limit GROUP BY lower(name))
+;
+
+DROP TABLE extractor_limit;
+ALTER TABLE extractor_limit_nocase RENAME TO extractor_limit;
+
+CREATE TRIGGER extractor_limit_version_insert AFTER INSERT ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER extractor_limit_version_update AFTER UPDATE ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+CREATE TRIGGER extractor_limit_version_delete AFTER DELETE ON extractor_limit
+    BEGIN
+        UPDATE setting SET settings_version = settings_version + 1;
+    END;
+
+UPDATE setting SET settings_version = settings_version + 1;
@@ -0,0 +1,13 @@
+-- Video listings are paged by id so that the cursor is just the id of the
+-- last video shown and videos without a download date aren't skipped
+-- Each index keeps the videos for one value in id order
+
+CREATE INDEX video_status_idx ON video (download_status);
+CREATE INDEX video_extractor_idx ON video (extractor_id);
+
+-- These kept each value in download date order, which listings no longer use
+-- Lookups by extractor and online id use the video's unique constraint
+-- video_datetime_idx stays for listings filtered by download date only
+
+DROP INDEX video_status_datetime_idx;
+DROP INDEX video_extractor_datetime_idx;
@@ -0,0 +1,73 @@
+-- Views
+
+DROP VIEW IF EXISTS video_details;
+CREATE VIEW video_details AS
+    SELECT
+        v.id AS id,
+        v.online_id AS online_id,
+        v.title AS title,
+        v.url AS url,
+        v.duration_s AS duration_s,
+        v.upload_date AS upload_date,
+        v.download_datetime AS download_datetime,
+        v.filepath AS filepath,
+        v.filepath_exists AS filepath_exists,
+        v.filepath_last_checked AS filepath_last_checked,
+        v.file_sha256 AS file_sha256,
+        v.file_size AS file_size,
+        v.file_verified_datetime AS file_verified_datetime,
+        v.file_corrupt AS file_corrupt,
+        c.id AS uploader_id,
+        c.online_title AS uploader_name,
+        c.url AS uploader_url,
+        e.id AS extractor_id,
+        e.name AS extractor,
+        f.id AS format_id,
+        f.label AS format_name,
+        f.value AS format,
+        v.download_status AS download_status,
+        ds.name AS download_status_name,
+        (v.download_status = 1) AS queued,
+        (v.download_status = 2) AS in_progress,
+        (v.download_status = 3) AS failed,
+        df.error_text AS error_text,
+        df.retry_count AS retry_count,
+        df.is_permanent AS is_permanent_failure
+    FROM video AS v
+        LEFT JOIN extractor AS e ON v.extractor_id = e.id
+        LEFT JOIN format AS f ON v.format_id = f.id
+        LEFT JOIN video_owner_xref AS vo ON v.id = vo.video_id
+        LEFT JOIN collection AS c ON vo.collection_id = c.id
+        LEFT JOIN download_status AS ds ON v.download_status = ds.id
+        LEFT JOIN download_failed AS df ON v.id = df.video_id
+;
+
+DROP VIEW IF EXISTS collection_details;
+CREATE VIEW collection_details AS
+    SELECT
+        c.id AS id,
+        c.online_id AS online_id,
+        c.online_title AS online_title,
+        c.custom_title AS title,
+        c.url AS url,
+        c.first_download_datetime AS first_download_datetime,
+        c.last_download_datetime AS last_download_datetime,
+        c.last_update_datetime AS last_update_datetime,
+        ct.id AS type_id,
+        ct.name AS type,
+        cs.id AS setting_id,
+        cs.title AS setting_title,
+        cs.description AS setting_description,
+        cs.download_concurrency AS download_concurrency,
+        u.id AS schedule_id,
+        u.name AS schedule_name,
+        u.description AS schedule_description,
+        e.id AS extractor_id,
+        e.name AS extractor
+    FROM collection AS c
+        LEFT JOIN collection_type AS ct ON c.type_id = ct.id
+        LEFT JOIN collection_setting AS cs ON c.setting_id = cs.id
+        LEFT JOIN update_sched AS u ON c.update_sched_id = u.id
+        LEFT JOIN extractor AS e ON c.extractor_id = e.id
+    ORDER BY title DESC
+;
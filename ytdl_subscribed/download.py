@@ -1,8 +1,31 @@
+import hashlib
+import http.client
+import itertools
+import json
 import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.error
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pprint import pformat, pprint
 
 import youtube_dl as ytdl
+from youtube_dl.utils import (
+    ContentTooShortError,
+    DownloadError,
+    GeoRestrictedError,
+    PagedList,
+    UnsupportedError,
+    bug_reports_message
+)
 
+from . import events, integrity, lease, limits
 from .db import YtdlDatabase
 from .log import log
 from .utils import (
@@ -12,7 +35,66 @@ from .utils import (
     ytdl_pretty_name
 )
 
-def download(url, request_options):
+# Per-thread database connections for helper threads
+thread_data = threading.local()
+
+# ytdl instances of every thread in this process by thread so that
+# the ones of finished playlist helper threads can still be saved
+ydl_caches = {}
+ydl_caches_lock = threading.Lock()
+
+# Number of playlist entries checked against the database at once
+LOOKUP_BATCH_SIZE = 100
+
+# Number of differently configured ytdl instances kept by each thread
+YDL_CACHE_SIZE = 4
+
+# Minimum time between progress events for a single download
+PROGRESS_INTERVAL_S = 1
+
+# Time between checks on a video that another job is downloading
+DOWNLOAD_WAIT_INTERVAL_S = 5
+
+# Failed downloads are retried this many times with the delay
+# doubling from `RETRY_BASE_S` up to at most `RETRY_MAX_S`
+RETRY_LIMIT = 5
+RETRY_BASE_S = 5 * 60
+RETRY_MAX_S = 12 * 60 * 60
+
+# HTTP statuses that mean the video is gone for good
+# Anything else (e.g. 429, 5xx, or YouTube's sporadic 403s) may go away
+PERMANENT_HTTP_CODES = (404, 410)
+
+# Network problems that are worth trying again later
+TRANSIENT_ERRORS = (
+    socket.timeout,
+    TimeoutError,
+    ConnectionError,
+    http.client.HTTPException,
+    urllib.error.URLError,
+    ContentTooShortError
+)
+
+# Messages of errors that retrying won't fix
+PERMANENT_ERROR_PATTERN = re.compile(r'''
+    video\ unavailable
+    | has\ been\ removed
+    | private\ video | video\ is\ private
+    | not\ (?:made\ )?available\ in\ your\ country | geo.?restrict
+    | account\ .*\ terminated
+    | copyright
+    | unsupported\ url
+    | members.only
+    | does\ not\ exist
+''', re.IGNORECASE | re.VERBOSE)
+
+# Color codes that ytdl adds to its messages on a terminal
+ANSI_ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+
+def get_process_db():
+    '''
+    Return the database connection that belongs to the current process.
+    '''
 
     # Import the process's database connection
     from .pool import db
@@ -23,118 +105,846 @@ def download(url, request_options):
     if (db is None):
         from .app import db
 
-    log.info(f'Processing request for {url}...')
+    return db
 
-    ydl_options = get_ydl_options(db, request_options)
+def get_thread_db():
+    '''
+    Return a database connection that belongs to the current thread.
 
-    with ytdl.YoutubeDL(ydl_options) as ydl:
+    Connections cannot be shared between threads so helper threads
+    (e.g. parallel playlist downloads) each open their own.
+    '''
 
-        # Download and extract the video metadata
-        data = ydl.extract_info(url, download=False)
-        log.debug(pformat(data))
+    if (not hasattr(thread_data, 'db')):
+        thread_data.db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
 
-        if ('_type' in data):
+    return thread_data.db
 
-            data_type = data['_type']
+class YoutubeDL(ytdl.YoutubeDL):
+    '''
+    ytdl that keeps the last error it reported in the current
+    thread, including errors that it was configured to ignore.
+    '''
 
-            # Source code includes video, playlist, compat_list, multi_video, url, and url_transparent
-            # Channels are represented as "Uploads" playlist on YouTube
-            if (data_type == 'video'):
-                download_video(db, data, request_options)
-            elif (data_type == 'playlist' or data_type == 'multi_video' or data_type == 'compat_list'):
-                download_playlist(db, data, request_options)
-            else:
-                msg = f'Unhandled ytdl response type: {data_type}'
-                log.error(msg)
-                return msg
+    def trouble(self, message=None, tb=None):
+
+        # Same as the exception ytdl raises when it doesn't ignore errors
+        exc_info = sys.exc_info()
+        if (hasattr(exc_info[1], 'exc_info') and exc_info[1].exc_info[0]):
+            exc_info = exc_info[1].exc_info
+
+        thread_data.ydl_error = DownloadError(message, exc_info)
+
+        super().trouble(message, tb)
+
+def pop_ydl_error():
+    '''
+    Return and forget the last error that ytdl reported
+    in the current thread or `None` if there was none.
+    '''
+
+    error = getattr(thread_data, 'ydl_error', None)
+    thread_data.ydl_error = None
+
+    return error
+
+def check_extracted(ytdl_info):
+    '''
+    Raise the error that ytdl reported if it returned no information.
+
+    ytdl returns `None` instead of raising when it is set to ignore errors.
+    '''
+
+    if (ytdl_info is None):
+        raise pop_ydl_error() or DownloadError('ytdl did not return any information')
+
+    return ytdl_info
+
+def iter_error_causes(error):
+    '''
+    Iterate over an error and everything that caused it, including
+    the original exceptions that ytdl wraps its errors around.
+    '''
+
+    seen = set()
+
+    while (not error is None and not id(error) in seen):
+
+        seen.add(id(error))
+        yield error
+
+        exc_info = getattr(error, 'exc_info', None)
+
+        if (getattr(error, 'cause', None)):
+            error = error.cause
+        elif (exc_info and exc_info[1] is not error and not exc_info[1] is None):
+            error = exc_info[1]
+        else:
+            error = error.__cause__ or error.__context__
+
+def is_permanent_error(error):
+    '''
+    Return whether a failed download should not be retried because the
+    video is gone (e.g. removed, private, or blocked in this country).
+
+    Unknown errors are assumed to be transient.
+    '''
+
+    causes = list(iter_error_causes(error))
+
+    for cause in causes:
+
+        if (isinstance(cause, urllib.error.HTTPError)):
+            return cause.code in PERMANENT_HTTP_CODES
+        if (isinstance(cause, (GeoRestrictedError, UnsupportedError))):
+            return True
+        if (isinstance(cause, TRANSIENT_ERRORS)):
+            return False
+
+    return any(PERMANENT_ERROR_PATTERN.search(str(cause)) for cause in causes)
+
+def get_error_text(error):
+    '''
+    Return the message of a download error without
+    ytdl's decorations (colors, prefix, and bug report notice).
+    '''
+
+    text = ANSI_ESCAPE_PATTERN.sub('', str(error))
+    text = text.replace(bug_reports_message(), '').strip()
+
+    if (text.startswith('ERROR: ')):
+        text = text[len('ERROR: '):]
+
+    return text or type(error).__name__
+
+def get_retry_not_before(retry):
+    '''
+    Return when the given retry of a failed download should run.
+
+    The delay doubles with each retry and is jittered so that
+    downloads that failed together don't all come back at once.
+    '''
+
+    delay_s = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** retry)
+    delay_s = random.uniform(delay_s / 2, delay_s)
+
+    return (datetime.now() + timedelta(seconds=delay_s)).strftime('%Y-%m-%d %H:%M:%S')
+
+def record_failure(db, video_db_id, request_options, error, priority=YtdlDatabase.priority.BACKFILL):
+    '''
+    Mark the download of a video as failed and queue it again
+    later with `priority` if the error is likely to go away.
+    '''
+
+    error_text = get_error_text(error)
+    is_permanent = is_permanent_error(error)
+    retry = request_options.get('retry', 0)
+
+    db.mark_download_ended(video_db_id, success=False, error_text=error_text,
+        is_permanent=is_permanent, retry_count=retry)
+
+    if (is_permanent):
+        log.warning(f'Not retrying video {video_db_id} since the error is permanent: {error_text}')
+        return
+
+    if (retry >= RETRY_LIMIT):
+        log.warning(f'Giving up on video {video_db_id} after {retry} retries: {error_text}')
+        return
+
+    not_before = get_retry_not_before(retry)
+    db.mark_download_queued(video_db_id, not_before=not_before,
+        priority=priority, retry=retry + 1, resume=request_options.get('resume', False),
+        collection_db_id=request_options.get('collection_id'))
+
+    log.info(f'Retrying video {video_db_id} after {not_before}')
+
+def record_entry_failure(db, video_info, request_options, error):
+    '''
+    Handle a playlist entry that failed before its video was recorded
+    (i.e. while its metadata was being resolved).
+
+    Entries with a known id are recorded as a placeholder video so
+    that the failure can be retried and listed like any other. Other
+    entries are queued again by their URL.
+
+    Returns the video_db_id of the entry or `None` if it has none.
+    '''
+
+    # Unresolved references only carry the key of the extractor that will resolve them
+    extractor_key = video_info.get('extractor_key') or video_info.get('ie_key')
+    url = video_info.get('webpage_url') or video_info.get('url')
+
+    if (not extractor_key or video_info.get('id') is None):
+
+        retry = request_options.get('retry', 0)
+        if (url and not is_permanent_error(error) and retry < RETRY_LIMIT):
+            db.queue_job(url, dict(request_options, url=url, retry=retry + 1),
+                collection_db_id=request_options.get('collection_id'), not_before=get_retry_not_before(retry),
+                priority=YtdlDatabase.priority.BACKFILL)
+
+        return None
+
+    with db.transaction(immediate=True):
+
+        video_data = db.get_video_by_extractor_id(extractor_key, str(video_info['id']))
+
+        if (video_data):
+            video_db_id = video_data['id']
 
         else:
+            # The file path is only known once the download is retried
+            placeholder = normalize_fields(dict(video_info, extractor_key=extractor_key,
+                extractor=video_info.get('extractor') or extractor_key, webpage_url=url, id=str(video_info['id']),
+                title=video_info.get('title') or str(video_info['id'])))
+            placeholder['___filepath'] = None
+
+            db.insert_extractor(placeholder)
+            video_db_id = db.insert_video(placeholder, request_options['format'])
+
+        record_failure(db, video_db_id, request_options, error)
+
+    return video_db_id
+
+def record_job_failure(db, job, request_options, error):
+    '''
+    Handle a job that failed before it got to download anything.
+
+    Jobs for a known video record the failure for the video. Other jobs
+    are queued again as a whole if the error is likely to go away.
+    '''
+
+    if (not job['video_id'] is None):
+        record_failure(db, job['video_id'], request_options, error)
+        return
+
+    retry = request_options.get('retry', 0)
+    if (is_permanent_error(error) or retry >= RETRY_LIMIT):
+        return
+
+    not_before = get_retry_not_before(retry)
+    # Not attached since the job being retried is still running
+    db.queue_job(job['url'], dict(request_options, retry=retry + 1), collection_db_id=job['collection_id'],
+        not_before=not_before, priority=YtdlDatabase.priority.BACKFILL, attach=False)
+
+    log.info(f'Retrying job {job["id"]} for {job["url"]} after {not_before}')
+
+def record_reaped_job(db, job, video_db_ids):
+    '''
+    Count a job whose lease expired as a failed attempt, given the
+    videos it was downloading as returned by `reap_expired_jobs`.
+
+    The videos are failed with `record_failure` under the job's priority
+    and collection and resume from their partial files when retried.
+    The job itself is retried after the same backoff or dropped once
+    it has used up its retries.
+
+    Returns whether the job was queued again.
+    '''
+
+    request_options = json.loads(job['request_options'])
+    retry = request_options.get('retry', 0)
+    error = DownloadError(f'Job {job["id"]} stopped making progress')
+
+    video_options = dict(request_options, resume=True, collection_id=job['collection_id'])
+    for video_db_id in video_db_ids:
+        record_failure(db, video_db_id, video_options, error, priority=job['priority'])
+
+    if (retry >= RETRY_LIMIT):
+        log.warning(f'Giving up on job {job["id"]} for {job["url"]} after {retry} retries')
+        db.remove_job(job['id'])
+        return False
+
+    # Otherwise already queued again along with its video
+    if (not job['video_id'] in video_db_ids):
+        db.reschedule_job(job['id'], dict(request_options, retry=retry + 1), get_retry_not_before(retry))
+
+    return True
+
+def get_ydl(ydl_options):
+    '''
+    Return a ytdl instance configured with `ydl_options` that belongs
+    to the current thread.
+
+    Creating an instance sets up the extractors, cookie jar, and opener
+    so instances are kept per thread (they are not thread-safe) and
+    reused by every download with the same options.
+    '''
+
+    options = sorted((str(name), value) for name, value in ydl_options.items())
+    key = hashlib.sha1(json.dumps(options, default=repr).encode('utf-8')).hexdigest()
+
+    if (not hasattr(thread_data, 'ydl_cache')):
+        thread_data.ydl_cache = OrderedDict()
+
+        with ydl_caches_lock:
+            ydl_caches[threading.current_thread()] = thread_data.ydl_cache
+
+    cache = thread_data.ydl_cache
+    ydl = cache.get(key)
+
+    if (ydl is None):
+        ydl = YoutubeDL(ydl_options)
+        ydl.add_progress_hook(publish_progress)
+        ydl.add_progress_hook(throttle_download)
+        ydl.add_progress_hook(lease.heartbeat)
+        cache[key] = ydl
+
+        if (len(cache) > YDL_CACHE_SIZE):
+            cache.popitem(last=False)[1].__exit__()
+
+    else:
+        cache.move_to_end(key)
+
+    # Only the counters are per run, everything else is configuration
+    ydl._download_retcode = 0
+    ydl._num_downloads = 0
+
+    return ydl
+
+def publish_progress(status):
+    '''
+    ytdl progress hook that publishes the progress of the
+    download running in the current thread.
+
+    Progress is published at most once every `PROGRESS_INTERVAL_S`
+    but the end of each file is always published. Merging and other
+    postprocessing follows the end of the last file.
+    '''
+
+    video_db_id = getattr(thread_data, 'video_db_id', None)
+    if (video_db_id is None):
+        return
+
+    stage = status['status']
+    now = time.monotonic()
+
+    if (stage == 'downloading'):
+        if (now - getattr(thread_data, 'progress_published', 0) < PROGRESS_INTERVAL_S):
+            return
+
+    thread_data.progress_published = now
+
+    events.publish('progress', {
+        'video_id': video_db_id,
+        'job_id': lease.job_db_id,
+        'stage': stage,
+        'filename': os.path.basename(status.get('filename') or ''),
+        'downloaded_bytes': status.get('downloaded_bytes'),
+        'total_bytes': status.get('total_bytes') or status.get('total_bytes_estimate'),
+        'speed': status.get('speed'),
+        'eta': status.get('eta'),
+        'elapsed': status.get('elapsed')
+    })
+
+def throttle_download(status):
+    '''
+    ytdl progress hook that holds the current thread's download back
+    while all downloads together are ahead of the bandwidth budget.
+    '''
+
+    if (limits.governor is None):
+        return
+
+    if (status['status'] != 'downloading'):
+        thread_data.throttle_position = None
+        return
+
+    filename = status.get('filename')
+    downloaded = status.get('downloaded_bytes') or 0
+
+    previous = getattr(thread_data, 'throttle_position', None)
+    thread_data.throttle_position = (filename, downloaded)
+
+    # The first report for a file includes anything resumed from disk
+    if (previous is None or previous[0] != filename or downloaded < previous[1]):
+        return
+
+    limits.governor.throttle(downloaded - previous[1])
+
+def save_ydl_state():
+    '''
+    Save anything the ytdl instances of every thread keep between
+    runs (i.e. the cookie jar when a cookie file is configured).
+
+    Only call this between jobs when no other thread is using its
+    instances. The instances of finished threads are let go after.
+    '''
+
+    with ydl_caches_lock:
+        caches = list(ydl_caches.items())
+
+        for thread, _ in caches:
+            if (not thread.is_alive()):
+                del ydl_caches[thread]
+
+    for _, cache in caches:
+        for ydl in cache.values():
+            ydl.__exit__()
+
+def run_job(job):
+    '''
+    Process a job that was claimed from the download queue.
+
+    The job is removed from the queue once processing
+    ends, whether or not the download succeeded.
+    '''
+
+    db = get_process_db()
+
+    if (not lease.take(db, job)):
+        log.warning(f'Job {job["id"]} for {job["url"]} was released before it could start')
+        return job['id']
+
+    events.publish('job', {'id': job['id'], 'url': job['url'], 'state': 'started'})
+
+    request_options = {}
+    try:
+        request_options = json.loads(job['request_options'])
+        error = download(job['url'], request_options)
+
+        if (len(error) > 0):
+            log.error(f'Job {job["id"]} for {job["url"]} failed: {error}')
+
+    except DownloadError as e:
+        # ytdl has already logged the reason
+        log.error(f'Job {job["id"]} for {job["url"]} failed')
+        record_job_failure(db, job, request_options, e)
+
+    except Exception as e:
+        log.exception(f'Job {job["id"]} for {job["url"]} raised an unexpected error')
+        record_job_failure(db, job, request_options, e)
+
+    finally:
+        lease.release()
+        save_ydl_state()
+        db.finish_job(job['id'], worker_id=lease.get_worker_id())
+
+        events.publish('job', {'id': job['id'], 'url': job['url'], 'state': 'finished'})
+
+    return job['id']
+
+def download(url, request_options):
+
+    db = get_process_db()
+
+    log.info(f'Processing request for {url}...')
+
+    # Updates are rescheduled even if they fail so that
+    # a failing collection isn't queued again right away
+    refresh_collection_id = request_options.get('refresh_collection_id')
+    if (not refresh_collection_id is None):
+        try:
+            return download_url(db, url, request_options)
+        finally:
+            db.mark_collection_updated(refresh_collection_id)
+
+    return download_url(db, url, request_options)
+
+def download_url(db, url, request_options):
+
+    ydl_options = get_ydl_options(db, request_options)
+
+    ydl = get_ydl(ydl_options)
+    pop_ydl_error()
+
+    # Only extract the top level metadata
+    # Playlist entries are resolved one at a time right before they
+    # are downloaded so that we don't wait on (or hold onto) the
+    # metadata for every entry of a large channel
+    data = ydl.extract_info(url, download=False, process=False)
+    data = resolve_references(ydl, check_extracted(data))
+    log.debug(pformat(data))
+
+    if ('_type' in data):
+
+        data_type = data['_type']
+
+        # Source code includes video, playlist, compat_list, multi_video, url, and url_transparent
+        # Channels are represented as "Uploads" playlist on YouTube
+        if (data_type == 'video'):
             download_video(db, data, request_options)
+        elif (data_type == 'playlist' or data_type == 'multi_video' or data_type == 'compat_list'):
+            download_playlist(db, data, request_options)
+        else:
+            msg = f'Unhandled ytdl response type: {data_type}'
+            log.error(msg)
+            return msg
+
+    else:
+        download_video(db, data, request_options)
 
     return ''
 
+def resolve_references(ydl, ytdl_info):
+    '''
+    Follow `url` and `url_transparent` results until an actual
+    video or playlist is reached without processing its entries.
+    '''
+
+    while (ytdl_info.get('_type') in ('url', 'url_transparent')):
+
+        resolved = ydl.extract_info(ytdl_info['url'], ie_key=ytdl_info.get('ie_key'), download=False, process=False)
+        resolved = check_extracted(resolved)
+
+        # Mirror ytdl: transparent references override any
+        # metadata that they provide themselves
+        if (ytdl_info['_type'] == 'url_transparent'):
+            for key, value in ytdl_info.items():
+                if (not value is None and not key in ('_type', 'url', 'id', 'extractor', 'extractor_key', 'ie_key')):
+                    resolved[key] = value
+
+        ytdl_info = resolved
+
+    return ytdl_info
+
+def iter_entries(entries):
+    '''
+    Lazily iterate over playlist entries from an unprocessed ytdl result.
+
+    Entries can be a list, a generator, or one of ytdl's paged lists.
+    Paged lists are fetched one page at a time. Extractors may also
+    leave them out (i.e. for an empty playlist).
+    '''
+
+    if (entries is None):
+        return
+
+    if (isinstance(entries, PagedList)):
+
+        page_size = getattr(entries, '_pagesize', 50)
+        start = 0
+
+        while (True):
+            page = entries.getslice(start, start + page_size)
+
+            if (len(page) == 0):
+                return
+
+            yield from page
+            start += page_size
+
+    else:
+        yield from entries
+
 def download_playlist(db, ytdl_info, request_options):
     '''
     Download all vidoes from the specified playlist.
+
+    Entries are downloaded in parallel using up to `download_concurrency`
+    threads as configured by the collection's settings or the request.
+    Entries are pulled from the playlist lazily so only a small window
+    of them is in memory at a time.
     '''
 
     ytdl_info = normalize_fields(ytdl_info)
 
-    db.insert_extractor(ytdl_info)
-    playlist_db_id = db.insert_collection(ytdl_info, YtdlDatabase.collection.PLAYLIST)
+    with db.transaction():
+        db.insert_extractor(ytdl_info)
+        playlist_db_id = db.insert_collection(ytdl_info, YtdlDatabase.collection.PLAYLIST)
+
+        # Submitted channels and playlists are only known to be
+        # one now that they have been extracted
+        if (not lease.job_db_id is None):
+            db.set_job_collection(lease.job_db_id, playlist_db_id)
+
+    concurrency = request_options.get('concurrency')
+    if (concurrency is None):
+        concurrency = db.get_collection(playlist_db_id)['download_concurrency']
+
+    concurrency = max(1, int(concurrency))
+
+    log.info(f'Downloading entries from {ytdl_pretty_name(ytdl_info)} using {concurrency} thread(s)')
+
+    # Retries of the entries are shared fairly under the playlist
+    entry_options = dict(request_options, collection_id=playlist_db_id)
+
+    def download_entry(i, video_info):
+
+        log.info(f'Processing playlist entry {i + 1}: {ytdl_pretty_name(ytdl_info)}')
+
+        return download_video(get_thread_db(), video_info, entry_options)
+
+    # Numbered before anything is left out so that
+    # the indices are the positions in the playlist
+    numbered_entries = enumerate(iter_entries(ytdl_info.get('entries')))
+
+    # When updating a channel, which lists its uploads newest first, stop
+    # at the first video we already have so that only the first page or
+    # so has to be fetched. Playlists can be in any order, so only the
+    # videos we already have are left out of them
+    # The videos are looked up in the collection that their indices
+    # are kept in, which differs from the subscribed one for channels
+    refresh_collection_id = request_options.get('refresh_collection_id')
+    is_newest_first = False
+    if (not refresh_collection_id is None):
+        known_ids = db.get_collection_online_ids(playlist_db_id)
+
+        def is_new(numbered_entry):
+            return not str(numbered_entry[1].get('id')) in known_ids
+
+        refresh_collection = db.get_collection(refresh_collection_id)
+        is_newest_first = (not refresh_collection is None
+            and refresh_collection['type_id'] == YtdlDatabase.collection.CHANNEL)
+
+        if (is_newest_first):
+            numbered_entries = itertools.takewhile(is_new, numbered_entries)
+        else:
+            numbered_entries = filter(is_new, numbered_entries)
 
-    total_vids = len(ytdl_info['entries'])
     video_ids = []
     video_indices = []
-    for i, video_info in enumerate(ytdl_info['entries']):
+    num_entries = 0
+
+    def collect(i, video_info, future):
+
+        lease.heartbeat()
 
-        log.info(f'Processing playlist entry {i + 1} of {total_vids}: {ytdl_pretty_name(ytdl_info)}')
+        try:
+            video_db_id = future.result()
+        except Exception as e:
+            log.exception(f'Playlist entry {i + 1} could not be processed')
+            video_db_id = record_entry_failure(db, video_info, entry_options, e)
 
-        video_db_id = download_video(db, video_info, request_options)
+        # Nested playlists are recorded as their own collection
+        if (video_db_id is None):
+            return
 
         video_ids.append(video_db_id)
-        video_indices.append(ytdl_info.get('playlist_index', i + 1))
+        video_indices.append(video_info.get('playlist_index') or i + 1)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='playlist') as executor:
+
+        # Keep a bounded window of submitted entries and
+        # collect in playlist order so the indices line up with the ids
+        pending = deque()
+
+        while (True):
+
+            batch = list(itertools.islice(numbered_entries, LOOKUP_BATCH_SIZE))
+            if (len(batch) == 0):
+                break
+
+            num_entries += len(batch)
+
+            # Skip anything that we already have before doing any per-entry work
+            present = find_present_entries(db, ytdl_info, batch)
+
+            for i, video_info in batch:
+
+                if (i in present):
+                    future = Future()
+                    future.set_result(present[i])
+                else:
+                    future = executor.submit(download_entry, i, video_info)
+
+                pending.append((i, video_info, future))
 
-    db.insert_video_collection_xref(video_ids, playlist_db_id, ordered_index=video_indices)
+                if (len(pending) >= concurrency * 2):
+                    collect(*pending.popleft())
+
+        while (len(pending) > 0):
+            collect(*pending.popleft())
+
+    log.info(f'Processed {len(video_ids)} entries from {ytdl_pretty_name(ytdl_info)}')
+
+    with db.transaction():
+
+        # Make room at the front for every new entry, including
+        # the ones that failed or turned out to be playlists
+        if (is_newest_first and num_entries > 0):
+            db.shift_collection_indices(playlist_db_id, num_entries)
+
+        db.insert_video_collection_xref(video_ids, playlist_db_id, ordered_index=video_indices)
 
     return playlist_db_id
 
+def find_present_entries(db, playlist_info, numbered_entries):
+    '''
+    Look up a batch of `(index, entry)` playlist entries in the database
+    using a single query.
+
+    Returns a dictionary mapping the index of each entry that has
+    already been downloaded and is still on disk to its video_db_id.
+    '''
+
+    keys = {}
+    for i, video_info in numbered_entries:
+
+        # Unresolved references only carry the key of the extractor that will resolve them
+        extractor_key = video_info.get('extractor_key') or video_info.get('ie_key')
+
+        if (extractor_key and video_info.get('id')):
+            keys[i] = (extractor_key, str(video_info['id']))
+
+    found = db.get_videos_by_extractor_ids(keys.values())
+
+    present = {}
+    for i, key in keys.items():
+
+        video_data = found.get(key)
+
+        if (video_data and video_data['filepath_exists'] and video_data['filepath'] and not video_data['file_corrupt']
+                and os.path.exists(video_data['filepath'])):
+            present[i] = video_data['id']
+
+    if (len(present) > 0):
+        log.info(f'Skipping {len(present)} entries of {ytdl_pretty_name(playlist_info)} that were already downloaded')
+
+    return present
+
+def wait_for_download(db, video_db_id, job_db_id):
+    '''
+    Wait until the job `job_db_id` is no longer downloading a video.
+
+    The current job is kept alive meanwhile. A job that dies or gets
+    stuck stops counting as downloading once its lease is reaped.
+    '''
+
+    while (True):
+
+        in_progress = db.get_download_in_progress(video_db_id)
+        if (in_progress is None or in_progress['job_id'] != job_db_id):
+            return
+
+        lease.heartbeat()
+        time.sleep(DOWNLOAD_WAIT_INTERVAL_S)
+
 def download_video(db, ytdl_info, request_options):
     '''
     Download the specified video.
+
+    Returns `None` if the entry turned out to be a nested playlist.
     '''
 
-    # Create a ytdl instance
+    # Reuse this thread's ytdl instance for these options
     ydl_options = get_ydl_options(db, request_options)
-    ydl = ytdl.YoutubeDL(ydl_options)
+    ydl = get_ydl(ydl_options)
+    pop_ydl_error()
+
+    # Lazily extracted playlist entries may only be references
+    # Resolve the full metadata and pick the format without downloading
+    ytdl_info = check_extracted(ydl.process_ie_result(ytdl_info, download=False))
+
+    if (ytdl_info.get('_type') in ('playlist', 'multi_video', 'compat_list')):
+        download_playlist(db, ytdl_info, request_options)
+        return None
 
     ytdl_info = normalize_fields(ytdl_info)
 
-    # Check if the video already exists
-    video_data = db.get_video_by_extractor_id(ytdl_info['extractor_key'], ytdl_info['id'])
+    # All bookkeeping before the download is committed at once
+    # The transaction starts before the video is looked up so that
+    # concurrent jobs with the same video (e.g. overlapping playlists)
+    # see each other instead of both inserting or downloading it
+    # Videos that another job is downloading are waited for and checked
+    # again once it is done, so that they are still downloaded if it fails
+    while (True):
 
-    file_exists = False
-    if (video_data):
+        file_exists = False
+        corrupt_filepath = None
+        downloading_job_db_id = None
+        with db.transaction(immediate=True):
 
-        video_db_id = video_data['id']
-        file_exists = os.path.exists(video_data['filepath'])
+            # Check if the video already exists
+            video_data = db.get_video_by_extractor_id(ytdl_info['extractor_key'], ytdl_info['id'])
 
-        db.mark_file_status(video_db_id, file_exists)
+            if (video_data):
 
-        log.info(f'Video "{ytdl_info["title"]}" ({ytdl_info["id"]}) already exists in the database. File present?: {file_exists}')
+                video_db_id = video_data['id']
+                filepath = video_data['filepath']
 
-    else:
-        # Insert the video and its required counterparts
-        # Automatically create the channel collection and
-        # add the video to it
-        db.insert_extractor(ytdl_info)
-        channel_db_id = db.insert_collection(ytdl_info, YtdlDatabase.collection.CHANNEL)
+                # Imported videos may have been recorded without a file
+                # Download them to where a new video would go
+                if (filepath is None):
+                    filepath = ydl.prepare_filename(ytdl_info)
+                    db.set_video_filepath(video_db_id, filepath)
+
+                file_exists = os.path.exists(filepath)
+
+                # Files that failed verification are downloaded again
+                # ytdl skips files that exist so the old one is moved aside
+                if (file_exists and video_data['file_corrupt']):
+                    log.warning(f'{filepath} is corrupt and will be downloaded again')
+                    corrupt_filepath = f'{filepath}.corrupt'
+                    file_exists = False
+
+                db.mark_file_status(video_db_id, file_exists)
+
+                log.info(f'Video "{ytdl_info["title"]}" ({ytdl_info["id"]}) already exists in the database. File present?: {file_exists}')
 
-        # Use our instance to create the filepath and sneak it
-        # in using the dictionary
-        ytdl_info['___filepath'] = ydl.prepare_filename(ytdl_info)
+                in_progress = db.get_download_in_progress(video_db_id)
+                if (not file_exists and in_progress and not in_progress['job_id'] in (None, lease.job_db_id)):
+                    downloading_job_db_id = in_progress['job_id']
 
-        video_db_id = db.insert_video(ytdl_info, request_options['format'])
+            else:
+                # Insert the video and its required counterparts
+                # Automatically create the channel collection and
+                # add the video to it
+                db.insert_extractor(ytdl_info)
+                channel_db_id = db.insert_collection(ytdl_info, YtdlDatabase.collection.CHANNEL)
+
+                # Use our instance to create the filepath and sneak it
+                # in using the dictionary
+                filepath = ydl.prepare_filename(ytdl_info)
+                ytdl_info['___filepath'] = filepath
+
+                video_db_id = db.insert_video(ytdl_info, request_options['format'])
+
+                db.insert_video_owner_xref(video_db_id, channel_db_id)
+
+            if (not file_exists and downloading_job_db_id is None):
+                db.mark_download_started(video_db_id, job_db_id=lease.job_db_id)
 
-        db.insert_video_owner_xref(video_db_id, channel_db_id)
+        if (downloading_job_db_id is None):
+            break
+
+        log.info(f'{ytdl_pretty_name(ytdl_info)} is already being downloaded by job {downloading_job_db_id}. Waiting for it to finish')
+        wait_for_download(db, video_db_id, downloading_job_db_id)
 
-    # Fetch the freshly inserted or updated information
-    video_data = db.get_video(video_db_id)
     success = file_exists
 
+    if (not corrupt_filepath is None):
+        try:
+            os.replace(filepath, corrupt_filepath)
+        except OSError as e:
+            log.warning(f'Could not move {filepath} aside: {e}')
+            corrupt_filepath = None
+
     if (not file_exists):
 
-        db.mark_download_started(video_db_id)
+        publish_video_status(video_db_id, ytdl_info, 'in_progress')
 
         log.info('')
         log.info(f'Starting download for {ytdl_pretty_name(ytdl_info)}...\n')
 
         # Actually download the video(s)
-        ydl.process_video_result(ytdl_info, download=True)
+        # Record errors as a failed download rather than losing the video
+        return_code = 1
+        error = None
+        thread_data.video_db_id = video_db_id
+        try:
+            # The format was already selected when the entry was resolved
+            # and is merged into the info like ytdl does when downloading
+            ydl.process_info(ytdl_info)
+            return_code = ydl._download_retcode
+        except DownloadError as e:
+            # ytdl has already logged the reason
+            error = e
+        except Exception as e:
+            log.exception(f'Error while downloading {ytdl_pretty_name(ytdl_info)}')
+            error = e
+        finally:
+            thread_data.video_db_id = None
+
+            # A download that raised may not have reported its end
+            lease.heartbeat()
 
         # Check disk for the output file so we don't have to rely on this
-        return_code = ydl._download_retcode
-        success = (os.path.exists(video_data['filepath']) and return_code == 0)
+        success = (os.path.exists(filepath) and return_code == 0)
+
+        # ytdl reports errors without raising when it is set to ignore them
+        reported_error = pop_ydl_error()
+        if (not success and error is None):
+            error = reported_error or DownloadError(f'Ytdl returned {return_code} but did not create {filepath}')
 
         log.info('')
         if (success):
@@ -142,7 +952,48 @@ def download_video(db, ytdl_info, request_options):
         else:
             log.error(f'Download failed for {ytdl_pretty_name(ytdl_info)}. Ytdl returned {return_code}')
 
-    db.mark_download_ended(video_db_id, success=success)
-    db.mark_file_status(video_db_id, success)
+        # Keep the corrupt file until there is a new one to replace it
+        if (not corrupt_filepath is None):
+            try:
+                if (success):
+                    os.remove(corrupt_filepath)
+                elif (not os.path.exists(filepath)):
+                    os.replace(corrupt_filepath, filepath)
+            except OSError as e:
+                log.warning(f'Could not clean up {corrupt_filepath}: {e}')
+
+    # Checksum the new file so that it can be verified later
+    # Done before the transaction to not hold the write lock while reading it
+    file_digest = None
+    if (success and not file_exists):
+        try:
+            file_digest = integrity.hash_file(filepath)
+        except OSError as e:
+            log.warning(f'Could not hash {filepath}: {e}')
+
+    # And everything after the download
+    with db.transaction():
+
+        if (success):
+            db.mark_download_ended(video_db_id, success=True)
+        else:
+            record_failure(db, video_db_id, request_options, error)
+
+        db.mark_file_status(video_db_id, success)
+
+        if (not file_digest is None):
+            db.mark_file_digest(video_db_id, *file_digest)
+
+    if (not file_exists):
+        publish_video_status(video_db_id, ytdl_info, 'complete' if success else 'failed')
 
     return video_db_id
+
+def publish_video_status(video_db_id, ytdl_info, status):
+
+    events.publish('video', {
+        'video_id': video_db_id,
+        'title': ytdl_info['title'],
+        'url': ytdl_info['webpage_url'],
+        'status': status
+    })
@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+from .log import log
+
+# Events that are waiting to be forwarded to subscribers
+# Publishers drop events rather than wait when this is full
+CHANNEL_SIZE = 1000
+
+# Events buffered for each subscriber before
+# new events are dropped for that subscriber
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Progress that hasn't been updated for this long is no longer
+# replayed to new subscribers (i.e. its worker was killed)
+PROGRESS_EXPIRE_S = 60
+
+# Each process's end of the event channel
+channel = None
+
+def set_channel(event_channel):
+    '''
+    Set the channel that the current process publishes events to.
+    '''
+
+    global channel
+    channel = event_channel
+
+def publish(event, data):
+    '''
+    Publish an event to anyone subscribed to the server's event stream.
+
+    Never blocks. Events are dropped if nobody is reading them fast enough.
+    '''
+
+    if (channel is None):
+        return
+
+    try:
+        channel.put_nowait((event, data))
+    except queue.Full:
+        pass
+
+class EventBroker():
+    '''
+    Forward events published by any process to the subscribers
+    of the main process's event stream.
+    '''
+
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if (EventBroker.__instance is None):
+            EventBroker()
+        return EventBroker.__instance
+
+    def __init__(self):
+
+        if (not EventBroker.__instance is None):
+            raise Exception('EventBroker is a singleton')
+
+        # Shared with the worker processes
+        self.channel = mp.Queue(CHANNEL_SIZE)
+        set_channel(self.channel)
+
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+        # Latest progress of every running download and when it was
+        # received so new subscribers don't have to wait for the next update
+        self.progress = {}
+
+        self.forwarder = threading.Thread(target=self._forward, name='events', daemon=True)
+        self.forwarder.start()
+
+        EventBroker.__instance = self
+
+    def subscribe(self):
+        '''
+        Return a queue that receives `(event, data)` tuples until
+        it is passed to `unsubscribe`.
+        '''
+
+        subscription = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+        expired = time.monotonic() - PROGRESS_EXPIRE_S
+
+        with self.lock:
+            for video_db_id, (data, received) in list(self.progress.items()):
+                if (received < expired):
+                    del self.progress[video_db_id]
+                else:
+                    subscription.put_nowait(('progress', data))
+
+            self.subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def _forward(self):
+
+        while (True):
+
+            try:
+                event, data = self.channel.get()
+            except (EOFError, OSError):
+                # The channel was closed on shutdown
+                return
+            except Exception:
+                log.exception('Could not read from the event channel')
+                continue
+
+            with self.lock:
+
+                if (event == 'progress' and data['stage'] == 'downloading'):
+                    self.progress[data['video_id']] = (data, time.monotonic())
+                elif (event in ('progress', 'video')):
+                    self.progress.pop(data['video_id'], None)
+
+                # Jobs that were queued again or ended (i.e. their worker
+                # was killed) can't be downloading anything anymore
+                elif (event == 'job' and data['state'] != 'started'):
+                    for video_db_id, (progress, _) in list(self.progress.items()):
+                        if (progress.get('job_id') == data['id']):
+                            del self.progress[video_db_id]
+
+                for subscription in self.subscribers:
+                    try:
+                        subscription.put_nowait((event, data))
+                    except queue.Full:
+                        pass
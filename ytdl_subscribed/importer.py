@@ -0,0 +1,236 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from datetime import datetime
+
+from .cli import open_database
+from .log import log
+
+# Suffix ytdl gives the metadata it writes next to each video
+INFO_JSON_SUFFIX = '.info.json'
+
+# Extensions of the files that ytdl downloads, merges, or recodes to
+MEDIA_EXTENSIONS = {
+    '3gp', 'aac', 'avi', 'flac', 'flv', 'm4a', 'm4v', 'mkv', 'mov',
+    'mp3', 'mp4', 'oga', 'ogg', 'ogv', 'opus', 'wav', 'webm'
+}
+
+# Metadata kept from each .info.json
+# The rest (e.g. the list of formats) is most of the file and isn't needed
+INFO_FIELDS = (
+    'extractor',
+    'extractor_key',
+    'id',
+    'title',
+    'webpage_url',
+    'duration',
+    'upload_date',
+    'uploader',
+    'uploader_id',
+    'uploader_url'
+)
+
+# Fields without which a video can't be recorded
+REQUIRED_FIELDS = ('extractor_key', 'id', 'title', 'webpage_url')
+
+# Number of .info.json files handed to a worker process at once
+PARSE_CHUNK_SIZE = 64
+
+# Number of videos inserted per transaction
+IMPORT_BATCH_SIZE = 5000
+
+def find_sidecars(paths):
+    '''
+    Find every .info.json file below the given directories along with
+    the media files that share its name.
+
+    Yields `(info_path, media_paths)` tuples. Each directory is only
+    listed once using `os.scandir`.
+    '''
+
+    pending = list(paths)
+
+    while (len(pending) > 0):
+
+        directory = pending.pop()
+
+        sidecars = []
+        media_by_stem = {}
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+
+                    if (entry.is_dir(follow_symlinks=False)):
+                        pending.append(entry.path)
+                        continue
+
+                    if (entry.name.endswith(INFO_JSON_SUFFIX)):
+                        sidecars.append(entry)
+                        continue
+
+                    stem, _, extension = entry.name.rpartition('.')
+                    if (extension.lower() in MEDIA_EXTENSIONS):
+                        media_by_stem.setdefault(stem, []).append(entry.path)
+
+        except OSError as e:
+            log.warning(f'Could not list {directory}: {e}')
+            continue
+
+        for sidecar in sidecars:
+            stem = sidecar.name[:-len(INFO_JSON_SUFFIX)]
+            yield (sidecar.path, media_by_stem.get(stem, []))
+
+def read_sidecar(sidecar):
+    '''
+    Read the metadata of a video from its .info.json file and stat its media file.
+
+    Returns the normalized metadata for `YtdlDatabase.import_videos`
+    or a dictionary with the `error` if the video can't be imported.
+    '''
+
+    info_path, media_paths = sidecar
+
+    try:
+        with open(info_path, encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError) as e:
+        return {'path': info_path, 'error': str(e)}
+
+    if (not isinstance(info, dict)):
+        return {'path': info_path, 'error': 'Not a video'}
+
+    video = {field: info.get(field) for field in INFO_FIELDS}
+
+    missing = [field for field in REQUIRED_FIELDS if (not video[field])]
+    if (len(missing) > 0):
+        return {'path': info_path, 'error': f'Missing {", ".join(missing)}'}
+
+    video['id'] = str(video['id'])
+    video['uploader_id'] = video['uploader_id'] and str(video['uploader_id'])
+
+    # Prefer the file ytdl says it wrote, which may have been
+    # merged or recoded to one of the others since
+    filepath = None
+    if (len(media_paths) > 0):
+        filepath = media_paths[0]
+
+        written_name = os.path.basename(info.get('_filename') or '')
+        for media_path in media_paths:
+            if (os.path.basename(media_path) == written_name):
+                filepath = media_path
+                break
+
+    # Listed as downloaded when the file was
+    download_datetime = None
+    try:
+        if (not filepath is None):
+            mtime = os.stat(filepath).st_mtime
+            download_datetime = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+    except OSError:
+        filepath = None
+
+    # Still record where the missing file belongs
+    if (filepath is None and info.get('_filename')):
+        filepath = os.path.join(os.path.dirname(info_path), os.path.basename(info['_filename']))
+
+    video['___filepath'] = filepath
+    video['___filepath_exists'] = (not download_datetime is None)
+    video['___download_datetime'] = download_datetime
+
+    return video
+
+def read_archive(path):
+    '''
+    Read the `(extractor, id)` pairs of a youtube-dl --download-archive file.
+
+    Extractors are lowercase in the archive.
+    '''
+
+    entries = set()
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+
+            parts = line.split(maxsplit=1)
+            if (len(parts) == 2):
+                entries.add((parts[0].lower(), parts[1].strip()))
+
+    return entries
+
+def main(args=None):
+    '''
+    Index a library downloaded with plain youtube-dl from the command line.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m ytdl_subscribed import',
+        description='Index videos downloaded with youtube-dl using their .info.json files without any network access.')
+    parser.add_argument('directories', nargs='+', help='directories to search for .info.json files')
+    parser.add_argument('--archive', action='append', default=[],
+        help='youtube-dl --download-archive file to check the library against (may be repeated)')
+    parser.add_argument('--format', type=int, help='id of the format to record the videos with (default: the default format)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes reading .info.json files')
+    args = parser.parse_args(args)
+
+    db = open_database()
+
+    format_id = args.format
+    if (format_id is None):
+        format_id = db.get_settings()['default_format']
+
+    start = time.monotonic()
+
+    num_read = 0
+    num_imported = 0
+    num_missing_files = 0
+    num_errors = 0
+    imported_keys = set()
+
+    def import_batch(batch):
+
+        with db.transaction():
+            return db.import_videos(batch, format_id)
+
+    # Parsing the metadata is the slow part so it's spread over processes
+    with mp.Pool(max(1, args.processes)) as pool:
+
+        batch = []
+
+        for video in pool.imap_unordered(read_sidecar, find_sidecars(args.directories), chunksize=PARSE_CHUNK_SIZE):
+
+            if ('error' in video):
+                log.warning(f'Skipping {video["path"]}: {video["error"]}')
+                num_errors += 1
+                continue
+
+            num_read += 1
+            num_missing_files += (not video['___filepath_exists'])
+            imported_keys.add((video['extractor_key'].lower(), video['id']))
+            batch.append(video)
+
+            if (len(batch) >= IMPORT_BATCH_SIZE):
+                num_imported += import_batch(batch)
+                batch = []
+                log.info(f'Read {num_read} videos...')
+
+        if (len(batch) > 0):
+            num_imported += import_batch(batch)
+
+    log.info(f'Imported {num_imported} of {num_read} videos in {time.monotonic() - start:.1f}s. '
+        + f'{num_missing_files} had no media file and {num_errors} .info.json files could not be read')
+
+    # The archive only has ids. Everything else about a video is in its .info.json
+    for archive_path in args.archive:
+
+        unmatched = read_archive(archive_path) - imported_keys
+
+        if (len(unmatched) > 0):
+            log.warning(f'{len(unmatched)} videos in {archive_path} have no .info.json and were not imported')
+            for extractor, online_id in sorted(unmatched)[:20]:
+                log.warning(f'    {extractor} {online_id}')
+        else:
+            log.info(f'Every video in {archive_path} was found')
+
+    return 0
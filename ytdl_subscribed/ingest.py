@@ -0,0 +1,157 @@
+import argparse
+import json
+import sys
+import urllib.parse
+from datetime import datetime
+
+from .cli import open_database
+from .db import YtdlDatabase
+from .log import log
+
+# Number of URLs queued per transaction when streaming results
+INGEST_BATCH_SIZE = 1000
+
+def parse_url_list(text):
+    '''
+    Parse a list of URLs given either as a JSON list or one URL per line.
+
+    Blank lines and lines starting with `#` are skipped.
+
+    Yields `(line, url)` tuples where `line` is the URL's 1-based line
+    number (or position in the JSON list).
+    '''
+
+    if (text.lstrip().startswith('[')):
+
+        urls = json.loads(text)
+
+        if (not isinstance(urls, list)):
+            raise ValueError('Expected a JSON list of URLs')
+
+        for i, url in enumerate(urls):
+            yield (i + 1, url)
+
+        return
+
+    for i, line in enumerate(text.splitlines()):
+
+        url = line.strip()
+        if (len(url) == 0 or url.startswith('#')):
+            continue
+
+        yield (i + 1, url)
+
+def validate_url(url):
+    '''
+    Return why `url` can't be queued or `None` if it can.
+    '''
+
+    if (not isinstance(url, str)):
+        return 'Not a string'
+
+    parts = urllib.parse.urlsplit(url)
+
+    if (not parts.scheme in ('http', 'https') or len(parts.netloc) == 0):
+        return 'Not an http(s) URL'
+
+    return None
+
+def ingest_urls(db, urls, format_id, not_before=None, priority=YtdlDatabase.priority.BACKFILL,
+        batch_size=INGEST_BATCH_SIZE, on_queued=None):
+    '''
+    Queue every valid URL from the `(line, url)` tuples of `parse_url_list`.
+
+    URLs are queued `batch_size` at a time in a single transaction
+    each (`None` for all of them at once). Yields one result per URL
+    once its batch is committed, with either the `job_id` it was
+    queued as or the `error` that kept it from being queued.
+
+    `on_queued` is called with the results of each committed batch.
+    '''
+
+    def queue_batch(batch):
+
+        results = []
+
+        with db.transaction():
+            for line, url in batch:
+
+                error = validate_url(url)
+                if (not error is None):
+                    results.append({'line': line, 'url': url, 'error': error})
+                    continue
+
+                request_options = {
+                    'url': url,
+                    'format': format_id
+                }
+                job_db_id = db.queue_job(url, request_options, not_before=not_before, priority=priority)
+
+                results.append({'line': line, 'url': url, 'job_id': job_db_id})
+
+        if (not on_queued is None):
+            on_queued(results)
+
+        return results
+
+    batch = []
+
+    for line, url in urls:
+
+        batch.append((line, url))
+
+        if (not batch_size is None and len(batch) >= batch_size):
+            yield from queue_batch(batch)
+            batch = []
+
+    if (len(batch) > 0):
+        yield from queue_batch(batch)
+
+def main(args=None):
+    '''
+    Queue every URL in a file (or stdin) from the command line.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m ytdl_subscribed ingest',
+        description='Queue a list of URLs (one per line or a JSON list) in a single transaction.')
+    parser.add_argument('file', help='file to read the URLs from or - for stdin')
+    parser.add_argument('--format', type=int, help='id of the format to download (default: the default format)')
+    parser.add_argument('--priority', choices=['interactive', 'refresh', 'backfill'], default='backfill')
+    parser.add_argument('--not-before', type=datetime.fromisoformat,
+        help='local date and time (YYYY-MM-DD HH:MM) before which the downloads may not start')
+    args = parser.parse_args(args)
+
+    if (args.file == '-'):
+        text = sys.stdin.read()
+    else:
+        with open(args.file, encoding='utf-8') as f:
+            text = f.read()
+
+    db = open_database()
+
+    format_id = args.format
+    if (format_id is None):
+        format_id = db.get_settings()['default_format']
+
+    priority = getattr(YtdlDatabase.priority, args.priority.upper())
+
+    not_before = None
+    if (not args.not_before is None):
+        not_before = args.not_before.strftime('%Y-%m-%d %H:%M:%S')
+
+    num_queued = 0
+    num_failed = 0
+
+    for result in ingest_urls(db, parse_url_list(text), format_id, not_before=not_before,
+            priority=priority, batch_size=None):
+
+        print(json.dumps(result))
+
+        if ('error' in result):
+            num_failed += 1
+        else:
+            num_queued += 1
+
+    log.info(f'Queued {num_queued} URL(s). {num_failed} could not be queued')
+
+    return 1 if num_failed > 0 else 0
@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cli import open_database
+from .log import log
+
+# Size of the reads that files are hashed with
+# Large enough that hashing rather than syscalls dominates
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of files looked up and recorded per transaction
+VERIFY_BATCH_SIZE = 1000
+
+# Number of files hashed at once
+# Hashing releases the GIL so threads hash in parallel
+VERIFY_THREADS = 4
+
+def hash_file(filepath):
+    '''
+    Hash a file in one streaming pass.
+
+    Returns its SHA-256 hex digest, size and modification
+    time in nanoseconds as they were when the hash started.
+    '''
+
+    digest = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    with open(filepath, 'rb', buffering=0) as f:
+
+        stat = os.fstat(f.fileno())
+
+        while (True):
+            num_read = f.readinto(buffer)
+            if (num_read == 0):
+                break
+            digest.update(view[:num_read])
+
+    return digest.hexdigest(), stat.st_size, stat.st_mtime_ns
+
+def verify_file(video, full=False):
+    '''
+    Check a file from `YtdlDatabase.get_files_to_verify` against its checksum.
+
+    Unless `full` is set only files whose size or modification time
+    changed are hashed again. Files without a checksum get one.
+
+    Returns the result for `YtdlDatabase.mark_files_verified`, or
+    `None` if the file was not hashed.
+    '''
+
+    try:
+        stat = os.stat(video['filepath'])
+
+        if (not full and video['file_sha256']
+                and stat.st_size == video['file_size'] and stat.st_mtime_ns == video['file_mtime_ns']):
+            return None
+
+        digest, size, mtime_ns = hash_file(video['filepath'])
+
+    except OSError as e:
+        # Missing files are left for the reconciler to notice
+        log.warning(f'Could not verify {video["filepath"]}: {e}')
+        return None
+
+    if (video['file_sha256'] is None or digest == video['file_sha256']):
+        return (digest, size, mtime_ns, False, video['id'])
+
+    log.warning(f'{video["filepath"]} does not match the checksum it was downloaded with')
+
+    return (video['file_sha256'], size, mtime_ns, True, video['id'])
+
+def verify_files(db, full=False, num_threads=VERIFY_THREADS, batch_size=VERIFY_BATCH_SIZE):
+    '''
+    Verify every downloaded file against its checksum.
+
+    Returns the number of files that were hashed and
+    the number of them that are corrupt.
+    '''
+
+    num_hashed = 0
+    num_corrupt = 0
+    num_files = 0
+    last_db_id = 0
+
+    with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='verify') as executor:
+
+        while (True):
+
+            files = db.get_files_to_verify(last_db_id, batch_size)
+            if (len(files) == 0):
+                break
+
+            last_db_id = files[-1]['id']
+            num_files += len(files)
+
+            results = [result for result in executor.map(lambda video: verify_file(video, full), files)
+                if (not result is None)]
+
+            if (len(results) > 0):
+                db.mark_files_verified(results)
+
+            num_hashed += len(results)
+            num_corrupt += sum(result[3] for result in results)
+
+    log.info(f'Verified {num_files} files, {num_hashed} of which were hashed. {num_corrupt} are corrupt')
+
+    return num_hashed, num_corrupt
+
+def main(args=None):
+    '''
+    Verify the downloaded files from the command line.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m ytdl_subscribed verify',
+        description='Check downloaded files against the checksums taken when they were downloaded.')
+    parser.add_argument('--full', action='store_true',
+        help='hash every file instead of only the ones whose size or modification time changed')
+    parser.add_argument('--threads', type=int, default=VERIFY_THREADS, help='number of files hashed at once')
+    args = parser.parse_args(args)
+
+    db = open_database()
+
+    start = time.monotonic()
+    verify_files(db, full=args.full, num_threads=max(1, args.threads))
+    log.info(f'Verification took {time.monotonic() - start:.1f}s')
+
+    # Files found corrupt by earlier runs are only skipped
+    # by this one if they haven't changed since
+    num_corrupt = db.count_corrupt_files()
+    if (num_corrupt > 0):
+        log.warning(f'{num_corrupt} files are corrupt and have not been downloaded again')
+
+    return 1 if num_corrupt > 0 else 0
@@ -0,0 +1,141 @@
+import os
+import socket
+import threading
+import time
+
+from .db import YtdlDatabase
+from .log import log
+from .utils import get_env_override
+
+# How long a claimed job belongs to its worker without being renewed
+LEASE_S = 45
+
+# Time between renewals of the running job's lease
+LEASE_RENEW_S = 10
+
+# Jobs whose downloads receive no data for this long stop renewing
+# their lease so that the dispatcher hands them to another worker
+# Other stages (i.e. extraction, ffmpeg downloads, and recoding) don't
+# report progress so the job is kept while its thread runs them
+STALL_S = 10 * 60
+
+# The job that the current process is running
+job_db_id = None
+
+# When each thread of the job that is receiving data last got some
+# Threads that are doing anything else aren't in here
+downloading = {}
+
+keeper = None
+lock = threading.Lock()
+
+def get_worker_id():
+    '''
+    Return the id that identifies the current process as the owner of its job.
+    '''
+
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def take(db, job):
+    '''
+    Take ownership of a claimed job for the current process and keep
+    renewing its lease until `release` is called.
+
+    Returns `False` if the job's lease already expired and it was
+    handed back to the queue.
+    '''
+
+    global job_db_id, keeper
+
+    if (not db.take_job(job['id'], job['claim_token'], get_worker_id(), LEASE_S)):
+        return False
+
+    with lock:
+        job_db_id = job['id']
+        downloading.clear()
+
+        if (keeper is None):
+            keeper = threading.Thread(target=_keep, name='lease', daemon=True)
+            keeper.start()
+
+    return True
+
+def release():
+    '''
+    Stop renewing the lease of the current process's job.
+    '''
+
+    global job_db_id
+
+    with lock:
+        job_db_id = None
+        downloading.clear()
+
+def get_worker_pid(worker_id):
+    '''
+    Return the process id in a `worker_id` or `None` if
+    the worker doesn't run on the current host.
+    '''
+
+    host, _, pid = (worker_id or '').rpartition(':')
+
+    if (host != socket.gethostname() or not pid.isdigit()):
+        return None
+
+    return int(pid)
+
+def heartbeat(status=None):
+    '''
+    Record what the current thread of the running job is doing.
+
+    Can be used as a ytdl progress hook. Only `downloading` statuses
+    are checked for stalls. Any other status, or none at all, marks
+    the thread as busy with something that doesn't report progress.
+    '''
+
+    thread_id = threading.get_ident()
+
+    with lock:
+        if (not status is None and status.get('status') == 'downloading'):
+            downloading[thread_id] = time.monotonic()
+        else:
+            downloading.pop(thread_id, None)
+
+def _forget(renew_db_id):
+
+    global job_db_id
+
+    with lock:
+        if (job_db_id == renew_db_id):
+            job_db_id = None
+
+def _keep():
+
+    # SQLite connections cannot be shared between threads
+    db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
+
+    while (True):
+
+        time.sleep(LEASE_RENEW_S)
+
+        with lock:
+            renew_db_id = job_db_id
+            stalled_s = max((time.monotonic() - progress for progress in downloading.values()), default=0)
+
+        if (renew_db_id is None):
+            continue
+
+        if (stalled_s > STALL_S):
+            log.warning(f'Job {renew_db_id} has not received any data in {int(stalled_s)}s. Giving up its lease')
+            _forget(renew_db_id)
+            continue
+
+        try:
+            renewed = db.renew_job_lease(renew_db_id, get_worker_id(), LEASE_S)
+        except Exception:
+            log.exception(f'Could not renew the lease of job {renew_db_id}')
+            continue
+
+        if (not renewed):
+            log.warning(f'Lost the lease of job {renew_db_id} to the reaper')
+            _forget(renew_db_id)
@@ -0,0 +1,242 @@
+import multiprocessing as mp
+import threading
+import time
+from collections import Counter
+
+from .utils import is_in_daily_window
+
+# Each process's handle on the shared bandwidth budget
+governor = None
+
+# Bandwidth that may be used at once after a pause
+BANDWIDTH_BURST_S = 1
+
+# Longest single pause so downloads notice when the budget is raised
+MAX_THROTTLE_S = 1
+
+def set_governor(bandwidth_governor):
+    '''
+    Set the governor that the current process's downloads are throttled by.
+    '''
+
+    global governor
+    governor = bandwidth_governor
+
+def get_scheduled_limit(schedule, now=None):
+    '''
+    Return the bandwidth limit in bytes per second that the
+    schedule sets for the given time or `None` if there is none.
+    '''
+
+    for window in schedule:
+        if (is_in_daily_window(window['start_time'], window['end_time'], now)):
+            return window['limit_kBps'] * 1024
+
+    return None
+
+class SiteLimiter():
+    '''
+    Track running jobs and job start rates per site so the dispatcher
+    can leave a site alone once it reaches its `extractor_limit`.
+
+    Rates are enforced with a token bucket per site that holds up to
+    `burst` tokens and refills at `jobs_per_minute`.
+
+    Not thread-safe. The caller is expected to serialize access.
+    '''
+
+    def __init__(self):
+
+        self.active = Counter()
+        self.tokens = {}
+        self.refilled = {}
+
+    def _refill(self, site, limit):
+
+        now = time.monotonic()
+
+        if (not site in self.tokens):
+            self.tokens[site] = limit['burst']
+        else:
+            elapsed = now - self.refilled[site]
+            self.tokens[site] = min(limit['burst'], self.tokens[site] + elapsed * limit['jobs_per_minute'] / 60)
+
+        self.refilled[site] = now
+
+    def get_blocked(self, limits):
+        '''
+        Return the sites that cannot start another job right now.
+        '''
+
+        blocked = []
+
+        for site, limit in limits.items():
+
+            if (not limit['max_concurrent'] is None and self.active[site] >= limit['max_concurrent']):
+                blocked.append(site)
+                continue
+
+            if (not limit['jobs_per_minute'] is None):
+                self._refill(site, limit)
+
+                if (self.tokens[site] < 1):
+                    blocked.append(site)
+
+        return blocked
+
+    def get_next_token_s(self, limits):
+        '''
+        Return the time until a site that is only blocked by its rate
+        gets its next token or `None` if no site is waiting on one.
+        '''
+
+        wait_s = None
+
+        for site, limit in limits.items():
+
+            if (limit['jobs_per_minute'] is None or self.tokens.get(site, 1) >= 1):
+                continue
+            if (not limit['max_concurrent'] is None and self.active[site] >= limit['max_concurrent']):
+                continue
+
+            site_wait_s = (1 - self.tokens[site]) * 60 / limit['jobs_per_minute']
+            if (wait_s is None or site_wait_s < wait_s):
+                wait_s = site_wait_s
+
+        return wait_s
+
+    def start(self, site, limits):
+        '''
+        Record that a job for the site was started.
+        '''
+
+        self.active[site] += 1
+
+        limit = limits.get(site)
+        if (not limit is None and not limit['jobs_per_minute'] is None):
+            self._refill(site, limit)
+            self.tokens[site] -= 1
+
+    def finish(self, site):
+        '''
+        Record that a job for the site ended.
+        '''
+
+        self.active[site] -= 1
+
+        if (self.active[site] <= 0):
+            del self.active[site]
+
+class BandwidthGovernor():
+    '''
+    Limit the combined download speed of every worker process.
+
+    All downloads draw from one token bucket in shared memory. Downloads
+    that get ahead of the budget sleep until it has caught up so
+    the bandwidth is divided between however many are active and
+    anything one download can't use is left for the others.
+    '''
+
+    def __init__(self, shared=None):
+
+        # Budget in bytes per second (0 for unlimited),
+        # available tokens, and time of the last refill
+        if (shared is None):
+            shared = mp.Array('d', [0, 0, time.monotonic()])
+
+        self.shared = shared
+
+    def get_budget(self):
+        '''
+        Return the current budget in bytes per second or `None` if unlimited.
+        '''
+
+        return self.shared[0] or None
+
+    def set_budget(self, bytes_per_s):
+        '''
+        Change the budget. `None` removes the limit.
+        '''
+
+        with self.shared.get_lock():
+            self.shared[0] = bytes_per_s or 0
+
+    def throttle(self, num_bytes):
+        '''
+        Account for `num_bytes` that were just downloaded and
+        sleep if the downloads are ahead of the budget.
+        '''
+
+        with self.shared.get_lock():
+
+            budget = self.shared[0]
+            if (budget <= 0):
+                return
+
+            now = time.monotonic()
+            tokens = min(budget * BANDWIDTH_BURST_S, self.shared[1] + (now - self.shared[2]) * budget)
+            tokens -= num_bytes
+
+            self.shared[1] = tokens
+            self.shared[2] = now
+
+        if (tokens < 0):
+            time.sleep(min(-tokens / budget, MAX_THROTTLE_S))
+
+class StreamLimiter():
+    '''
+    Cap the number of long-lived responses (i.e. event streams and media
+    files sent through Python) so that they can't take up every request
+    thread of the server.
+
+    Responses hold their slot from `acquire` until the body returned by
+    `wrap` is closed by the server.
+    '''
+
+    def __init__(self, max_streams):
+
+        self.slots = threading.BoundedSemaphore(max_streams)
+
+    def acquire(self):
+        '''
+        Take a slot without waiting. Returns `False` if there is none left.
+        '''
+
+        return self.slots.acquire(blocking=False)
+
+    def wrap(self, body):
+        '''
+        Wrap a response body so that its slot is given back when it is closed.
+        '''
+
+        return LimitedBody(body, self.slots.release)
+
+class LimitedBody():
+    '''
+    Response body that calls `release` once when it is closed.
+
+    Everything else is passed on to the wrapped body so that file
+    bodies are still handed to the server's `wsgi.file_wrapper`.
+    '''
+
+    def __init__(self, body, release):
+
+        self.body = body
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def __getattr__(self, name):
+        return getattr(self.body, name)
+
+    def close(self):
+
+        try:
+            if (hasattr(self.body, 'close')):
+                self.body.close()
+        finally:
+            if (not self.released):
+                self.released = True
+                self.release()
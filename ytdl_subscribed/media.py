@@ -0,0 +1,192 @@
+import email.utils
+import mimetypes
+import os
+from urllib.parse import quote
+
+from bottle import HTTPError, HTTPResponse, parse_date, parse_range_header, request
+
+from .utils import get_env_override
+
+# Size of each read when the server cannot send the file itself
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Seconds that clients are told to wait when every stream slot is taken
+STREAM_RETRY_S = 5
+
+def serve_media(filepath, download=True, limiter=None):
+    '''
+    Return a response that sends the given media file to the client.
+
+    Supports `HEAD`, single `Range` requests (with `If-Range`), and
+    conditional requests using an `ETag` and `Last-Modified` based on the
+    file's stat. Whole files and ranges that run to the end of the file
+    are handed to the server's `wsgi.file_wrapper` which lets servers
+    that support it (e.g. gunicorn) use `sendfile` instead of copying the
+    file through Python.
+
+    If `YDL_SERVER_ACCEL` is set to `nginx` or `sendfile` the body is left
+    to a front proxy using `X-Accel-Redirect` or `X-Sendfile`.
+
+    Bodies sent through Python hold a slot of `limiter` (a
+    `StreamLimiter`) if given and are refused with a 503 when it is full.
+    '''
+
+    # Imported videos may not know where their file belongs
+    if (filepath is None):
+        raise HTTPError(404, 'The file for the requested video does not exist.')
+
+    # Relative paths come from the output template so they
+    # are relative to the directory the server was started in
+    filepath = os.path.abspath(filepath)
+
+    try:
+        stats = os.stat(filepath)
+    except OSError:
+        raise HTTPError(404, 'The file for the requested video does not exist.')
+
+    if (not os.path.isfile(filepath) or not os.access(filepath, os.R_OK)):
+        raise HTTPError(403, 'The file for the requested video cannot be read.')
+
+    headers = get_media_headers(filepath, stats, download)
+
+    accel = get_env_override('YDL_SERVER_ACCEL', default='').lower()
+    if (accel == 'nginx'):
+        headers['X-Accel-Redirect'] = get_accel_uri(filepath)
+        return HTTPResponse('', **headers)
+    elif (accel == 'sendfile'):
+        headers['X-Sendfile'] = filepath
+        return HTTPResponse('', **headers)
+
+    if (is_not_modified(headers, stats)):
+        return HTTPResponse(status=304, **headers)
+
+    size = stats.st_size
+    start, end = 0, size
+    status = 200
+
+    range_header = request.environ.get('HTTP_RANGE')
+    if (range_header and is_range_current(headers)):
+
+        ranges = list(parse_range_header(range_header, size))
+
+        # Multipart responses aren't worth it for media players
+        # so only the first range is sent
+        if (len(ranges) == 0):
+            raise HTTPError(416, 'Requested Range Not Satisfiable', **{'Content-Range': f'bytes */{size}'})
+
+        start, end = ranges[0]
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    headers['Content-Length'] = str(end - start)
+
+    if (request.method == 'HEAD'):
+        return HTTPResponse('', status=status, **headers)
+
+    if (not limiter is None and not limiter.acquire()):
+        raise HTTPError(503, 'Too many files are being sent. Try again later.', **{'Retry-After': STREAM_RETRY_S})
+
+    media_file = open(filepath, 'rb')
+    media_file.seek(start)
+
+    # Bottle hands file objects to the server's file wrapper which sends
+    # everything from the current position on (limited to Content-Length
+    # at best) so only pass the file itself when the range is the tail
+    if (end == size):
+        body = media_file
+    else:
+        body = iter_file_range(media_file, end - start)
+
+    if (not limiter is None):
+        body = limiter.wrap(body)
+
+    return HTTPResponse(body, status=status, **headers)
+
+def get_media_headers(filepath, stats, download):
+    '''
+    Build the headers that are common to every response for the file.
+    '''
+
+    mimetype, encoding = mimetypes.guess_type(filepath)
+
+    headers = {
+        'Content-Type': mimetype or 'application/octet-stream',
+        'Accept-Ranges': 'bytes',
+        'Last-Modified': email.utils.formatdate(stats.st_mtime, usegmt=True),
+        'ETag': f'"{stats.st_ino:x}-{stats.st_size:x}-{stats.st_mtime_ns:x}"'
+    }
+
+    if (download):
+        filename = os.path.basename(filepath)
+        fallback = filename.encode('ascii', 'replace').decode('ascii').replace('"', '')
+        headers['Content-Disposition'] = f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(filename)}'
+
+    return headers
+
+def get_accel_uri(filepath):
+    '''
+    Map a file to the internal nginx location that serves it.
+
+    The location is `YDL_SERVER_ACCEL_PREFIX` (default `/protected/`)
+    followed by the path relative to `YDL_SERVER_ACCEL_ROOT` (default
+    the working directory).
+    '''
+
+    prefix = get_env_override('YDL_SERVER_ACCEL_PREFIX', default='/protected/')
+    root = os.path.abspath(get_env_override('YDL_SERVER_ACCEL_ROOT', default=os.getcwd()))
+
+    relative = os.path.relpath(filepath, root)
+    if (relative.startswith(os.pardir)):
+        raise HTTPError(403, 'The file for the requested video is outside of YDL_SERVER_ACCEL_ROOT.')
+
+    return prefix.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+
+def is_not_modified(headers, stats):
+    '''
+    Check the request's conditional headers against the file.
+    '''
+
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if (if_none_match):
+        return (if_none_match.strip() == '*' or headers['ETag'] in [tag.strip() for tag in if_none_match.split(',')])
+
+    if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    if (if_modified_since):
+        if_modified_since = parse_date(if_modified_since.split(';')[0].strip())
+        return (not if_modified_since is None and if_modified_since >= int(stats.st_mtime))
+
+    return False
+
+def is_range_current(headers):
+    '''
+    Check that `If-Range` (if any) still matches the file so a client
+    never stitches together ranges from two different versions.
+    '''
+
+    if_range = request.environ.get('HTTP_IF_RANGE')
+    if (not if_range):
+        return True
+
+    if_range = if_range.strip()
+    if (if_range.startswith('"') or if_range.startswith('W/')):
+        return (if_range == headers['ETag'])
+
+    return (if_range == headers['Last-Modified'])
+
+def iter_file_range(media_file, length):
+    '''
+    Yield `length` bytes from the current position of `media_file`
+    and close it afterwards.
+    '''
+
+    try:
+        while (length > 0):
+            block = media_file.read(min(READ_BLOCK_SIZE, length))
+            if (not block):
+                break
+
+            length -= len(block)
+            yield block
+
+    finally:
+        media_file.close()
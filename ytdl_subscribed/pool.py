@@ -1,16 +1,34 @@
 import multiprocessing as mp
+import os
 import signal
+import threading
+import time
+from functools import partial
 
+from . import events, lease, limits, reconcile
 from .db import YtdlDatabase
+from .download import record_reaped_job, run_job
+from .limits import BandwidthGovernor, SiteLimiter
 from .log import log
 from .utils import get_env_override
 
 # Each process's unique db connection
 db = None
 
-def init_proc():
+# Maximum time between checks of the job queue
+DISPATCH_INTERVAL_S = 5
+
+# Time between checks for collections that are due for an update
+REFRESH_INTERVAL_S = 15 * 60
+
+# Time between checks for files that are due to be checked again
+RECONCILE_INTERVAL_S = 15 * 60
+
+def init_proc(event_channel, bandwidth):
     global db
     db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
+    events.set_channel(event_channel)
+    limits.set_governor(BandwidthGovernor(bandwidth))
 
 class WorkPool():
 
@@ -27,19 +45,264 @@ class WorkPool():
         if (not WorkPool.__instance is None):
             raise Exception('WorkPool is a singleton')
 
-        num_procs = get_env_override('YDL_MAX_PROCESSES', mp.cpu_count() // 2)
+        num_procs = int(get_env_override('YDL_MAX_PROCESSES', max(1, mp.cpu_count() // 2)))
 
         log.debug(f'Creating process pool with {num_procs} processes')
 
+        # Workers publish their progress through the broker's channel
+        event_channel = events.EventBroker.get_instance().channel
+
+        # The budget is set by the dispatcher and shared by every download
+        self.governor = BandwidthGovernor()
+        limits.set_governor(self.governor)
+
         # Ignore the SIGINT (Ctrl-C) interrupt in the subprocesses
         preserved_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        self.pool = mp.Pool(num_procs, initializer=init_proc)
+        self.pool = mp.Pool(num_procs, initializer=init_proc, initargs=(event_channel, self.governor.shared))
         signal.signal(signal.SIGINT, preserved_handler)
 
+        self.num_procs = num_procs
+        self.num_active = 0
+
+        # Slots held by each dispatched claim so that the slots of jobs
+        # whose worker died or got stuck can be freed when their lease expires
+        self.active_jobs = {}
+
+        # Workers that only interactive jobs may use so that they
+        # start right away even when background jobs pile up
+        reserved = int(get_env_override('YDL_INTERACTIVE_PROCESSES', default=1))
+        self.max_background = max(1, num_procs - reserved)
+        self.num_background = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+        # Per-site limits are only applied here so
+        # access is serialized by self.lock
+        self.limiter = SiteLimiter()
+
+        # Jobs are claimed from the database by a single dispatcher
+        # so that a slot is only taken when a worker is free
+        self.dispatcher = threading.Thread(target=self._dispatch, name='dispatcher', daemon=True)
+        self.dispatcher.start()
+
+        # Files are checked in the background so that ones that were
+        # deleted or moved are noticed without waiting on a download
+        self.reconciler = threading.Thread(target=self._reconcile_files, name='reconciler', daemon=True)
+        self.reconciler.start()
+
         WorkPool.__instance = self
 
+    def notify(self):
+        '''
+        Wake the dispatcher so that newly queued jobs are claimed immediately.
+        '''
+        self.wakeup.set()
+
+    def _dispatch(self):
+
+        # SQLite connections cannot be shared between threads
+        dispatch_db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
+
+        next_refresh = 0
+
+        while (not self.stopped):
+
+            if (time.monotonic() >= next_refresh):
+                next_refresh = time.monotonic() + REFRESH_INTERVAL_S
+
+                try:
+                    self._queue_collection_refreshes(dispatch_db)
+                except Exception:
+                    log.exception('Could not queue collection updates')
+
+            try:
+                self.update_bandwidth_budget(dispatch_db)
+            except Exception:
+                log.exception('Could not update the bandwidth budget')
+
+            try:
+                self._reap_expired_jobs(dispatch_db)
+            except Exception:
+                log.exception('Could not release expired jobs')
+
+            try:
+                site_limits = dispatch_db.get_extractor_limits()
+            except Exception:
+                log.exception('Could not load the extractor limits')
+                site_limits = {}
+
+            while (self.num_active < self.num_procs):
+
+                # Leave jobs for sites that are at their limit in the queue
+                # so that other sites can keep the remaining workers busy
+                with self.lock:
+                    blocked = self.limiter.get_blocked(site_limits)
+
+                max_priority = None
+                if (self.num_background >= self.max_background):
+                    max_priority = YtdlDatabase.priority.INTERACTIVE
+
+                try:
+                    job = dispatch_db.claim_next_job(lease.LEASE_S, skip_sites=blocked, max_priority=max_priority)
+                except Exception:
+                    log.exception('Could not claim a job from the download queue')
+                    break
+
+                if (job is None):
+                    break
+
+                log.debug(f'Dispatching job {job["id"]} for {job["url"]}')
+
+                site = job['site'] or ''
+                is_background = (job['priority'] != YtdlDatabase.priority.INTERACTIVE)
+
+                with self.lock:
+                    self.num_active += 1
+                    self.num_background += is_background
+                    self.limiter.start(site, site_limits)
+                    self.active_jobs[job['claim_token']] = (site, is_background)
+
+                job_done = partial(self._job_done, job['claim_token'])
+                self.pool.apply_async(run_job, (dispatch_db.result_to_simple_type(job),),
+                    callback=job_done, error_callback=job_done)
+
+            # Check again as soon as a rate limited site may start another job
+            with self.lock:
+                next_token_s = self.limiter.get_next_token_s(site_limits)
+
+            timeout = DISPATCH_INTERVAL_S
+            if (not next_token_s is None):
+                timeout = min(timeout, next_token_s)
+
+            self.wakeup.wait(timeout=timeout)
+            self.wakeup.clear()
+
+    def _reconcile_files(self):
+
+        # SQLite connections cannot be shared between threads
+        reconcile_db = YtdlDatabase.factory(get_env_override('YDL_DB_BACKEND', default='sqlite'))
+
+        while (not self.stopped):
+
+            try:
+                reconcile.reconcile_files(reconcile_db, should_stop=lambda: self.stopped)
+            except Exception:
+                log.exception('Could not check the downloaded files')
+
+            stop_time = time.monotonic() + RECONCILE_INTERVAL_S
+            while (not self.stopped and time.monotonic() < stop_time):
+                time.sleep(DISPATCH_INTERVAL_S)
+
+    def update_bandwidth_budget(self, dispatch_db):
+        '''
+        Apply the bandwidth limit that is scheduled for the current time.
+        '''
+
+        budget = limits.get_scheduled_limit(dispatch_db.get_bandwidth_schedule())
+
+        if (budget != self.governor.get_budget()):
+            log.info(f'Bandwidth budget changed to {budget // 1024 if budget else "unlimited"} kB/s')
+            self.governor.set_budget(budget)
+
+    def _queue_collection_refreshes(self, dispatch_db):
+        '''
+        Queue an update job for every collection whose update schedule is due.
+        '''
+
+        collections = dispatch_db.get_due_collections()
+        if (len(collections) == 0):
+            return
+
+        default_format = dispatch_db.get_settings()['default_format']
+
+        for collection in collections:
+            request_options = {
+                'url': collection['url'],
+                'format': default_format,
+                'refresh_collection_id': collection['id']
+            }
+            job_db_id = dispatch_db.queue_job(collection['url'], request_options, collection_db_id=collection['id'],
+                priority=YtdlDatabase.priority.REFRESH)
+            events.publish('job', {'id': job_db_id, 'url': collection['url'], 'state': 'queued'})
+
+        log.info(f'Queued updates for {len(collections)} collection(s)')
+
+    def _reap_expired_jobs(self, dispatch_db):
+        '''
+        Put jobs whose worker stopped renewing their lease back into the
+        queue.
+
+        A slot is only freed once its process is free again. Workers that
+        are stuck on a job are killed so that the pool replaces them, while
+        jobs that are still waiting for a process keep their slot until the
+        process finds out that the job was released.
+        '''
+
+        # Counted as failed in the same transaction so
+        # that the videos are never left unqueued
+        with dispatch_db.transaction(immediate=True):
+            jobs, interrupted = dispatch_db.reap_expired_jobs()
+
+            requeued = [record_reaped_job(dispatch_db, job, interrupted[job['id']]) for job in jobs]
+
+        for job, is_requeued in zip(jobs, requeued):
+            log.warning(f'Lease of job {job["id"]} for {job["url"]} expired')
+
+            if (not job['worker_id'] is None):
+                self._stop_worker(job)
+                self._free_slot(job['claim_token'])
+
+            events.publish('job', {'id': job['id'], 'url': job['url'], 'state': 'queued' if is_requeued else 'finished'})
+
+    def _stop_worker(self, job):
+        '''
+        Kill the pool process that is stuck on a job whose lease expired.
+
+        The pool replaces killed processes but never reports back on the
+        jobs they were running.
+        '''
+
+        pid = lease.get_worker_pid(job['worker_id'])
+
+        with self.lock:
+            is_running = job['claim_token'] in self.active_jobs
+
+        # Only kill processes of this pool that still run the job
+        if (pid is None or not is_running or not pid in [process.pid for process in mp.active_children()]):
+            return
+
+        log.warning(f'Stopping worker {pid} since it is stuck on job {job["id"]}')
+
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            # Already gone
+            pass
+
+    def _free_slot(self, claim_token):
+
+        with self.lock:
+
+            # Already freed when the job's lease expired
+            if (not claim_token in self.active_jobs):
+                return
+
+            site, is_background = self.active_jobs.pop(claim_token)
+            self.num_active -= 1
+            self.num_background -= is_background
+            self.limiter.finish(site)
+
+        self.wakeup.set()
+
+    def _job_done(self, claim_token, result):
+
+        self._free_slot(claim_token)
+
     def __del__(self):
 
         log.info('Stopping process pool...')
+        self.stopped = True
+        self.wakeup.set()
         self.pool.close()
         self.pool.join()
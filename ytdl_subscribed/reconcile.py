@@ -0,0 +1,102 @@
+import os
+import time
+
+from .log import log
+
+# Files are checked again once their last check is this old
+FILE_CHECK_MAX_AGE_S = 24 * 60 * 60
+
+# Number of videos whose files are checked per transaction
+FILE_CHECK_BATCH_SIZE = 5000
+
+# Pause between batches so that downloads can get the write lock
+FILE_CHECK_PAUSE_S = 0.5
+
+def list_directory(directory):
+    '''
+    Return the names in a directory, an empty set if it doesn't exist,
+    or `None` if it couldn't be read.
+    '''
+
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+    except OSError as e:
+        log.warning(f'Could not list {directory}: {e}')
+        return None
+
+def check_files(files, listings):
+    '''
+    Check whether the files of the rows from `YtdlDatabase.get_files_to_check`
+    exist using the directory listings in `listings`.
+
+    Directories are listed once and added to `listings` so that the
+    files in them are found without a `stat` per file. Files in
+    directories that couldn't be read keep their current status.
+
+    Returns the statuses for `YtdlDatabase.mark_files_status`.
+    '''
+
+    statuses = []
+
+    for video in files:
+
+        directory, name = os.path.split(video['filepath'])
+
+        if (not directory in listings):
+            listings[directory] = list_directory(directory or '.')
+
+        names = listings[directory]
+        if (names is None):
+            is_present = video['filepath_exists']
+        else:
+            is_present = (name in names)
+
+        statuses.append((is_present, video['id'], video['filepath'], video['filepath_last_checked']))
+
+    return statuses
+
+def reconcile_files(db, max_age_s=FILE_CHECK_MAX_AGE_S, batch_size=FILE_CHECK_BATCH_SIZE,
+        pause_s=FILE_CHECK_PAUSE_S, should_stop=None):
+    '''
+    Check the files of every video that wasn't checked in the last
+    `max_age_s` seconds, the longest unchecked first, `batch_size` at a time.
+
+    Every directory is only listed once per call. Files that appear
+    or disappear after their directory was listed are caught by the
+    next call.
+
+    Returns the number of files checked.
+    '''
+
+    listings = {}
+
+    num_checked = 0
+    num_appeared = 0
+    num_missing = 0
+
+    while (should_stop is None or not should_stop()):
+
+        files = db.get_files_to_check(max_age_s, batch_size)
+        if (len(files) == 0):
+            break
+
+        statuses = check_files(files, listings)
+        db.mark_files_status(statuses)
+
+        was_present = {video['id']: video['filepath_exists'] for video in files}
+        for is_present, video_db_id, _, _ in statuses:
+            num_appeared += (is_present and not was_present[video_db_id])
+            num_missing += (was_present[video_db_id] and not is_present)
+
+        num_checked += len(statuses)
+
+        time.sleep(pause_s)
+
+    if (num_checked > 0):
+        log.info(f'Checked {num_checked} files in {len(listings)} directories. '
+            + f'{num_missing} went missing and {num_appeared} reappeared')
+
+    return num_checked
@@ -1,7 +1,43 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer
 
 from .app import app, bottle_pip_update, db
 from .log import log
+from .utils import get_env_override
+
+class PooledWSGIServer(WSGIServer):
+    '''
+    WSGI server that handles each request on a fixed pool of threads.
+
+    Long running responses (i.e. file downloads and event streams) only
+    tie up one thread and the threads (along with their database
+    connections) are reused between requests.
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        num_threads = max(1, int(get_env_override('YDL_SERVER_THREADS', default=32)))
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='request')
+
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+
+        super().server_close()
+        self.executor.shutdown(wait=False)
 
 def main():
 
@@ -23,4 +59,5 @@ def main():
     app_vars = db.get_settings()
 
     app.run(host=app_vars['YDL_SERVER_HOST'],
-            port=app_vars['YDL_SERVER_PORT'], catchall=True, debug=True, reloader=False)
+            port=app_vars['YDL_SERVER_PORT'], catchall=True, debug=True, reloader=False,
+            server_class=PooledWSGIServer)
@@ -1,7 +1,17 @@
 import os
 import random
+import re
 import string
-from datetime import datetime
+import urllib.parse
+from datetime import datetime, timedelta
+from functools import lru_cache
+from heapq import merge
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    # Before Python 3.11
+    import sre_constants, sre_parse
 
 from .log import log
 
@@ -48,6 +58,53 @@ def generate_id():
     return 'ytdl_' + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") # + '_' + \
         #''.join(random.choices(string.ascii_lowercase + string.ascii_uppercase + string.digits, k=10))
 
+# Times of day as compared by is_in_daily_window
+TIME_OF_DAY_PATTERN = re.compile(r'(?:[01][0-9]|2[0-3]):[0-5][0-9]')
+
+def is_time_of_day(value):
+    '''
+    Check if a value is a time of day written as `HH:MM`.
+    '''
+
+    return (isinstance(value, str) and not TIME_OF_DAY_PATTERN.fullmatch(value) is None)
+
+def is_in_daily_window(start_time, end_time, now=None):
+    '''
+    Check if `now` falls within the daily window from `start_time`
+    up to `end_time` (`HH:MM`, local time).
+
+    Windows where the start is after the end wrap around midnight.
+    '''
+
+    if (now is None):
+        now = datetime.now()
+
+    now = now.strftime('%H:%M')
+
+    if (start_time <= end_time):
+        return (start_time <= now < end_time)
+    else:
+        return (now >= start_time or now < end_time)
+
+def get_daily_window_start(start_time, end_time, now=None):
+    '''
+    Return the next time that the daily window from `start_time` up to
+    `end_time` (`HH:MM`, local time) opens or `now` if it is already open.
+    '''
+
+    if (now is None):
+        now = datetime.now()
+
+    if (is_in_daily_window(start_time, end_time, now)):
+        return now
+
+    start = datetime.combine(now.date(), datetime.strptime(start_time, '%H:%M').time())
+
+    if (start <= now):
+        start += timedelta(days=1)
+
+    return start
+
 def get_ydl_options(db, request_options):
     '''
     Create a dictionary of "command-line" options for use with
@@ -82,8 +139,30 @@ def get_ydl_options(db, request_options):
     # ratelimit
     # progresshooks?
 
+    format_id = request_options['format']
+
+    # Resolved once per format until the settings change. The active
+    # profile is covered too since it can only change through the
+    # settings or the environment (which is fixed for the process)
+    # A copy is returned so callers are free to modify it
+    options = db.get_cached_setting(('resolved_ydl_options', format_id),
+        lambda: resolve_ydl_options(db, format_id))
+    options = dict(options)
+
+    # Interrupted downloads pick up where they left off
+    if (request_options.get('resume')):
+        options['continuedl'] = True
+
+    return options
+
+def resolve_ydl_options(db, format_id):
+    '''
+    Build the ytdl options for the given format from the
+    settings of the active profile.
+    '''
+
     options = {
-        'format': db.get_format(request_options['format']),
+        'format': db.get_format(format_id),
         'call_home': False,
         'logger': log
     }
@@ -99,6 +178,274 @@ def get_ydl_options(db, request_options):
 
     return options
 
+# Loaded on first use by get_extractor_classes
+extractor_classes = None
+
+# Built on first use by get_extractor_host_index
+extractor_host_index = None
+
+# Last part of the names of the extractors for channels,
+# playlists, and other lists of videos (e.g. `youtube:tab`)
+COLLECTION_EXTRACTOR_SUFFIXES = {
+    'album', 'albums', 'channel', 'channels', 'collection', 'favorites',
+    'likes', 'playlist', 'playlists', 'season', 'series', 'set', 'sets',
+    'show', 'tab', 'user', 'videos'
+}
+
+# Number of hosts whose extractors are remembered by get_host_extractor_classes
+# Checking every extractor's pattern takes milliseconds per URL
+URL_SITE_CACHE_SIZE = 4096
+
+# Limits for listing the hosts that an extractor's URL pattern matches.
+# Patterns past them (i.e. `[^/]+\.example\.com`) are tried for every host
+MAX_PATTERN_HOSTS = 256
+MAX_PATTERN_CHARSET = 40
+MAX_PATTERN_REPEAT = 8
+
+# Characters that end the host of a URL
+HOST_END_CHARS = '/?#:'
+
+class UnlistableHostsError(Exception):
+    pass
+
+def get_extractor_classes():
+    '''
+    Return every ytdl extractor class in the order ytdl tries them.
+    '''
+
+    from youtube_dl.extractor import gen_extractor_classes
+
+    global extractor_classes
+    if (extractor_classes is None):
+        extractor_classes = gen_extractor_classes()
+
+    return extractor_classes
+
+def get_extractor_name(extractor_class):
+    '''
+    Return the `IE_NAME` of an extractor class.
+
+    Extractors that don't set one only compute it on instances
+    from their class name, which is what `ie_key` returns.
+    '''
+
+    name = extractor_class.IE_NAME
+    if (not isinstance(name, str)):
+        name = extractor_class.ie_key()
+
+    return name
+
+def is_collection_url(url):
+    '''
+    Guess whether a URL is for a channel, playlist, or other list of
+    videos rather than a single video from the name of the first
+    extractor that handles it.
+
+    Only the extractors' URL patterns are checked so no network access is needed.
+    '''
+
+    for extractor_class in get_extractor_classes():
+        if (extractor_class.suitable(url)):
+
+            name = get_extractor_name(extractor_class)
+            return name.rpartition(':')[2].lower() in COLLECTION_EXTRACTOR_SUFFIXES
+
+    return False
+
+def get_pattern_hosts(pattern):
+    '''
+    List every (lowercase) host that URLs matched by a regular expression can have.
+
+    Raises `UnlistableHostsError` if the pattern could match URLs on hosts
+    that aren't known in advance or on too many hosts to list.
+    '''
+
+    texts = set()
+
+    def is_host_done(text):
+        return ('://' in text and any(c in text.partition('://')[2] for c in HOST_END_CHARS))
+
+    def add_text(text):
+        texts.add(text.lower())
+        if (len(texts) > MAX_PATTERN_HOSTS):
+            raise UnlistableHostsError()
+
+    def get_charset(items):
+        chars = set()
+        for op, value in items:
+            if (op is sre_constants.LITERAL):
+                chars.add(chr(value))
+            elif (op is sre_constants.RANGE and value[1] - value[0] < MAX_PATTERN_CHARSET):
+                chars.update(chr(c) for c in range(value[0], value[1] + 1))
+            else:
+                raise UnlistableHostsError()
+        return chars
+
+    # Expands the pattern into every text it can start with up to the end
+    # of the host, calling `then` with each text once `items` are used up
+    def expand(items, i, text, then):
+
+        if (is_host_done(text)):
+            return add_text(text)
+
+        if (i == len(items)):
+            return then(text)
+
+        op, value = items[i]
+        expand_next = lambda next_text: expand(items, i + 1, next_text, then)
+
+        if (op is sre_constants.LITERAL):
+            expand_next(text + chr(value))
+
+        elif (op is sre_constants.IN):
+            for c in get_charset(value):
+                expand_next(text + c)
+
+        elif (op is sre_constants.BRANCH):
+            for branch in value[1]:
+                expand(list(branch), 0, text, expand_next)
+
+        elif (op is sre_constants.SUBPATTERN):
+            expand(list(value[-1]), 0, text, expand_next)
+
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and value[1] <= MAX_PATTERN_REPEAT):
+            min_count, max_count, repeated = value
+
+            def expand_repeat(count, repeat_text):
+                if (count >= min_count):
+                    expand_next(repeat_text)
+                if (count < max_count):
+                    expand(list(repeated), 0, repeat_text, lambda next_text: expand_repeat(count + 1, next_text))
+
+            expand_repeat(0, text)
+
+        # Anchors and lookarounds don't add any text
+        elif (op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)):
+            expand_next(text)
+
+        else:
+            raise UnlistableHostsError()
+
+    try:
+        expand(list(sre_parse.parse(pattern)), 0, '', add_text)
+    except RecursionError:
+        raise UnlistableHostsError()
+
+    hosts = set()
+    for text in texts:
+
+        # Patterns that can match without a host (i.e. `ytuser:...`)
+        # can't be ruled out by the host
+        scheme, separator, rest = text.partition('://')
+        if (len(separator) == 0):
+            raise UnlistableHostsError()
+
+        hosts.add(re.split(f'[{re.escape(HOST_END_CHARS)}]', rest, maxsplit=1)[0])
+
+    return hosts
+
+def get_extractor_host_index():
+    '''
+    Return the positions in `get_extractor_classes` of the extractors
+    that may match URLs on any host and a dictionary of the positions
+    of the other extractors by the hosts that they match.
+    '''
+
+    from youtube_dl.extractor.common import InfoExtractor
+
+    global extractor_host_index
+    if (extractor_host_index is None):
+
+        any_host = []
+        by_host = {}
+
+        for i, extractor_class in enumerate(get_extractor_classes()):
+
+            # Extractors that decide for themselves can't be ruled out
+            pattern = getattr(extractor_class, '_VALID_URL', None)
+            is_own_check = not getattr(extractor_class.suitable, '__func__', None) is InfoExtractor.suitable.__func__
+            if (is_own_check or not isinstance(pattern, str)):
+                any_host.append(i)
+                continue
+
+            try:
+                hosts = get_pattern_hosts(pattern)
+            except UnlistableHostsError:
+                any_host.append(i)
+                continue
+
+            for host in hosts:
+                by_host.setdefault(host, []).append(i)
+
+        extractor_host_index = (any_host, by_host)
+
+    return extractor_host_index
+
+@lru_cache(maxsize=URL_SITE_CACHE_SIZE)
+def get_host_extractor_classes(host):
+    '''
+    Return the ytdl extractor classes that may match URLs on
+    the given host in the order ytdl tries them.
+    '''
+
+    classes = get_extractor_classes()
+    any_host, by_host = get_extractor_host_index()
+
+    return tuple(classes[i] for i in merge(any_host, by_host.get(host, [])))
+
+def get_url_site(url):
+    '''
+    Return the lowercase name of the site whose ytdl extractors handle the
+    given URL (e.g. `youtube` for videos, channels, and playlists alike).
+
+    Only the extractors' URL patterns are checked so no network access is needed.
+    Only the extractors that can match the URL's host are tried. The
+    site itself isn't remembered per host since a host can be shared
+    by several sites (i.e. `bbc` and `bbc.co.uk`).
+    '''
+
+    try:
+        host = urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        host = None
+
+    if (host is None):
+        candidate_classes = get_extractor_classes()
+    else:
+        candidate_classes = get_host_extractor_classes(host)
+
+    for extractor_class in candidate_classes:
+        if (extractor_class.suitable(url)):
+            return get_extractor_name(extractor_class).split(':')[0].lower()
+
+    return None
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = ('feature', 'si', 'fbclid', 'gclid')
+
+def normalize_url(url):
+    '''
+    Normalize a URL so that the same page compares equal however
+    it was written (scheme, case of the host, `www.` and `m.`
+    subdomains, trailing slashes, order of the query, tracking
+    parameters, and the fragment don't matter).
+    '''
+
+    parts = urllib.parse.urlsplit(url.strip())
+
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.'):
+        if (host.startswith(prefix)):
+            host = host[len(prefix):]
+            break
+
+    query = sorted(
+        (name, value) for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if (not name in TRACKING_PARAMS and not name.startswith('utm_'))
+    )
+
+    return urllib.parse.urlunsplit(('https', host, parts.path.rstrip('/'), urllib.parse.urlencode(query), ''))
+
 def merge_env_db_settings(db_settings, quiet=True):
     '''
     Merge settings from the database with settings from the environment.
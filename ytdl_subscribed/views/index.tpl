@@ -29,6 +29,12 @@
 					%end
 				</select>
 
+				%if (not maintenance_window is None):
+				<label title="Wait for the maintenance window ({{maintenance_window}}) before starting">
+					<input type="checkbox" name="defer" value="maintenance"> Off-peak
+				</label>
+				%end
+
 				<button class="input__btn" type="submit" id="button-submit">Submit</button>
 			</div>
 		</form>
@@ -36,18 +42,18 @@
 		%if (len(failed) > 0):
 		<div id="failed">
 			<h2>Failed</h2>
-			%include('table-video-summary.tpl', iter=failed)
+			%include('table-video-summary.tpl', iter=failed, more=failed_more)
 		</div>
 		%end
 
 		<div id="queued">
 			<h2>Queued</h2>
-			%include('table-video-summary.tpl', iter=queue)
+			%include('table-video-summary.tpl', iter=queue, more=queue_more)
 		</div>
 
 		<div id="Recent">
 			<h2>Recent</h2>
-			%include('table-video-summary.tpl', iter=history)
+			%include('table-video-summary.tpl', iter=history, more=history_more)
 		</div>
 
 	</main>
@@ -32,6 +32,20 @@
         </td>
     </tr>
 
+    <tr>
+        <td>
+            %if ('YDL_MAINTENANCE_START' in overrides or 'YDL_MAINTENANCE_END' in overrides):
+            <span class="icon" title="{{ov.format('YDL_MAINTENANCE_START/YDL_MAINTENANCE_END')}}">🔒</span></td>
+            %end
+        </td>
+        <td title="Off-peak jobs wait for this daily window before starting">
+            <b>Maintenance window:</b>
+        </td>
+        <td>
+            <code>{{s['YDL_MAINTENANCE_START']}}-{{s['YDL_MAINTENANCE_END']}}</code>
+        </td>
+    </tr>
+
     %for opt in ydl_options:
     <tr>
         <td>
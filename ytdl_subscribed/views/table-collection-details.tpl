@@ -23,6 +23,10 @@
         <td><b>Inclusion/exclusion criteria:</b></td>
         <td><span title="{{item['setting_description']}}">{{item['setting_title']}}</span></td>
     </tr>
+    <tr>
+        <td><b>Concurrent downloads:</b></td>
+        <td>{{item['download_concurrency']}}</td>
+    </tr>
     <tr>
         <td><b>Update schedule:</b></td>
         <td><span title="{{item['schedule_description']}}">{{item['schedule_name']}}</span></td>
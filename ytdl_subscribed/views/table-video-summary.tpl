@@ -15,7 +15,7 @@
         <td>{{item['download_datetime']}}</td>
         <td>
             %if (item['failed']):
-            <span title="Download failed!">❌</span>
+            <span title="{{item['error_text'] or 'Download failed!'}}">❌</span>
             %elif (item['in_progress']):
             <img src="static/loading.svg" alt="Loading..." width="24px">
             %else:
@@ -26,3 +26,7 @@
     %end
 
 </table>
+
+%if (get('more')):
+<p class="more"><a href="{{more}}">Older</a></p>
+%end